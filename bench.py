@@ -0,0 +1,574 @@
+"""
+Навантажувальний бенчмарк вебхука голосування.
+
+Програє синтетичні оновлення Telegram для повного сценарію (/start -> код -> контакт -> голос)
+через aiohttp-маршрут handle_telegram_webhook. Bot API замінено фейковим транспортом, а Google
+Sheets — таблицею в пам'яті з керованою затримкою та часткою помилок, тож бенчмарк працює офлайн.
+
+Звіт: пропускна здатність, p50/p95/p99 для кожного обробника та кроку вебхука, кількість
+звернень до Sheets API на один голос. З --json результати дописуються рядком JSON разом із
+хешем коміту, щоб порівнювати їх між комітами (параметри та seed фіксовані).
+
+Приклад:
+    python bench.py --voters 500 --concurrency 50 --sheets-latency 0.1 --json bench_results.jsonl
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import gspread
+from aiohttp.test_utils import TestClient, TestServer
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+import main
+
+BENCH_TOKEN = "123456:BENCHMARK"
+
+# --- ФЕЙКОВИЙ GOOGLE SHEETS ---
+
+class FakeApiResponse:
+    """Мінімальна відповідь HTTP, достатня для конструктора gspread.exceptions.APIError."""
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.text = json.dumps(self.json())
+
+    def json(self) -> Dict[str, Any]:
+        return {'error': {'code': self.status_code, 'message': 'Injected by benchmark', 'status': 'UNAVAILABLE'}}
+
+class FakeSpreadsheet:
+    """Таблиця в пам'яті з інтерфейсом gspread.Spreadsheet, затримкою та ін'єкцією помилок."""
+    def __init__(self, tabs: Dict[str, List[List[Any]]], latency: float, error_rate: float, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+        self.cells_read = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._worksheets = {title: FakeWorksheet(self, title, values) for title, values in tabs.items()}
+
+    def api_call(self, name: str) -> None:
+        """Імітує один запит до API: рахує його, чекає затримку та інколи повертає 429/503."""
+        with self._lock:
+            self.calls[name] += 1
+            failed = self._random.random() < self.error_rate
+            status = self._random.choice([429, 503])
+            delay = self.latency * self._random.uniform(0.5, 1.5)
+        time.sleep(delay)
+        if failed:
+            raise gspread.exceptions.APIError(FakeApiResponse(status))
+
+    def worksheet(self, title: str) -> 'FakeWorksheet':
+        self.api_call('worksheet')
+        if title not in self._worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+class FakeWorksheet:
+    """Вкладка таблиці в пам'яті з тими методами gspread.Worksheet, якими користується бот."""
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str, values: List[List[Any]]):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.values = values
+
+    def _copy(self) -> List[List[str]]:
+        with self.spreadsheet._lock:
+            return [[str(v) for v in row] for row in self.values]
+
+    def get_all_values(self) -> List[List[str]]:
+        self.spreadsheet.api_call('get_all_values')
+        values = self._copy()
+        self.spreadsheet.cells_read += sum(len(row) for row in values)
+        return values
+
+    def batch_get(self, ranges: List[str], major_dimension: Optional[str] = None, **kwargs) -> List[List[List[str]]]:
+        """Підтримує діапазони однієї колонки ('C1', 'C2:C', 'C2:C10') з major_dimension='COLUMNS'."""
+        assert major_dimension == 'COLUMNS'
+        self.spreadsheet.api_call('batch_get')
+        values = self._copy()
+        result = []
+        for a1 in ranges:
+            start, _, end = a1.partition(':')
+            first_row, col = gspread.utils.a1_to_rowcol(start)
+            if not end:
+                last_row = first_row
+            elif end[-1].isdigit():
+                last_row = gspread.utils.a1_to_rowcol(end)[0]
+            else:
+                last_row = len(values)
+            column = [
+                values[row - 1][col - 1] if col - 1 < len(values[row - 1]) else ''
+                for row in range(first_row, min(last_row, len(values)) + 1)
+            ]
+            while column and column[-1] == '':
+                column.pop()
+            self.spreadsheet.cells_read += len(column)
+            result.append([column] if column else [])
+        return result
+
+    def get_all_records(self) -> List[Dict[str, Any]]:
+        self.spreadsheet.api_call('get_all_records')
+        values = self._copy()
+        return [dict(zip(values[0], row)) for row in values[1:]]
+
+    def row_values(self, row: int) -> List[str]:
+        self.spreadsheet.api_call('row_values')
+        return self._copy()[row - 1]
+
+    def _set(self, row: int, col: int, value: Any) -> None:
+        while len(self.values) < row:
+            self.values.append([])
+        cells = self.values[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def update_cell(self, row: int, col: int, value: Any) -> None:
+        self.spreadsheet.api_call('update_cell')
+        with self.spreadsheet._lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs) -> None:
+        self.spreadsheet.api_call('batch_update')
+        with self.spreadsheet._lock:
+            for item in data:
+                row, col = gspread.utils.a1_to_rowcol(item['range'])
+                self._set(row, col, item['values'][0][0])
+
+    def append_row(self, values: List[Any], **kwargs) -> None:
+        self.spreadsheet.api_call('append_row')
+        with self.spreadsheet._lock:
+            self.values.append(list(values))
+
+    def append_rows(self, rows: List[List[Any]], **kwargs) -> None:
+        self.spreadsheet.api_call('append_rows')
+        with self.spreadsheet._lock:
+            self.values.extend(list(row) for row in rows)
+
+def make_codes(voters: int, election_index: int = 0, elections: int = 1) -> List[List[Any]]:
+    """Детерміновані коди для вкладки 'Codes': по одному на кожного віртуального виборця цих виборів."""
+    classes = list(main.CLASS_CONFIG)
+    rows = [list(main.CODES_HEADER)]
+    for i in range(election_index, voters, elections):
+        class_name = classes[i % len(classes)]
+        rows.append([class_name, main.CLASS_CONFIG[class_name], f"B{i:07d}", 'FALSE', '', '', ''])
+    return rows
+
+# --- ФЕЙКОВИЙ ТРАНСПОРТ TELEGRAM BOT API ---
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт Bot API, який не ходить у мережу, а одразу повертає правдоподібні відповіді."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result: Any = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            result = {
+                'message_id': params.get('message_id', self._message_id),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+# --- СИНТЕТИЧНІ ОНОВЛЕННЯ ---
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"Voter{user_id}", 'username': f"voter{user_id}"}
+
+def _message(update_id: int, user_id: int, **fields) -> Dict[str, Any]:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+    }
+    message.update(fields)
+    return {'update_id': update_id, 'message': message}
+
+def spam_updates(count: int, voters: int, election_ids: List[str]) -> List[Dict[str, Any]]:
+    """Оновлення, які бот має відкинути: стікери, чужі кнопки та повторні доставки вже оброблених оновлень."""
+    updates = []
+    for i in range(count):
+        user_id = 20_000_000 + i
+        kind = i % 3
+        if kind == 0:
+            updates.append(_message(10_000_000 + i, user_id, sticker={
+                'file_id': f"sticker{i}", 'file_unique_id': f"s{i}", 'width': 512, 'height': 512,
+                'is_animated': False, 'is_video': False, 'type': 'regular'}))
+        elif kind == 1:
+            updates.append({'update_id': 10_000_000 + i, 'callback_query': {
+                'id': str(i), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': f"other_{i}"}})
+        else:
+            # Повторна доставка голосу одного з виборців
+            index = i % max(1, voters)
+            election_id = election_ids[index % len(election_ids)]
+            updates.append(voter_updates(index, f"B{index:07d}", next(iter(main.CANDIDATES)), election_id)[-1][1])
+    return updates
+
+def voter_updates(index: int, code: str, candidate_key: str, election_id: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """Чотири оновлення повного сценарію голосування для одного виборця."""
+    user_id = 10_000_000 + index
+    base = index * 10
+    return [
+        ('start', _message(base + 1, user_id, text='/start',
+                           entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])),
+        ('receive_code', _message(base + 2, user_id, text=code)),
+        ('receive_contact', _message(base + 3, user_id, contact={
+            'phone_number': f"+380{user_id}", 'first_name': f"Voter{user_id}", 'user_id': user_id})),
+        ('handle_vote', {'update_id': base + 4, 'callback_query': {
+            'id': str(base + 4),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': f"vote_{election_id}:{candidate_key}",
+            'message': {'message_id': base + 3, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': 'Зробіть свій вибір'},
+        }}),
+    ]
+
+# --- ВИМІРЮВАННЯ ---
+
+class Recorder:
+    """Збирає час виконання обробників і сповіщає виборців про завершення обробки їхніх оновлень."""
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self._completed: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+
+    def wrap(self, callback):
+        name = callback.__name__
+
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self.latency[name].append(time.perf_counter() - started)
+                if update.effective_user is not None:
+                    self._completed[update.effective_user.id].put_nowait(name)
+        return timed
+
+    async def wait_handled(self, user_id: int) -> str:
+        return await self._completed[user_id].get()
+
+def instrument_handlers(application: Application, recorder: Recorder) -> None:
+    """Обгортає колбеки всіх обробників таймером."""
+    for group in application.handlers.values():
+        for handler in group:
+            handler.callback = recorder.wrap(handler.callback)
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50) * 1000, 3),
+        'p95_ms': round(pick(0.95) * 1000, 3),
+        'p99_ms': round(pick(0.99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+def measure_sessions(count: int) -> Dict[str, Any]:
+    """
+    Пам'ять на одного виборця посеред розмови та вартість планування тайм-ауту:
+    SessionStore (слотовий запис + колесо таймерів) проти словника user_data з окремим таймером на розмову.
+    """
+    classes = list(main.CLASS_CONFIG)
+
+    def traced(build) -> Tuple[float, float, Any]:
+        tracemalloc.start()
+        started = time.perf_counter()
+        keep = build()
+        elapsed = time.perf_counter() - started
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / count, elapsed / count, keep
+
+    def build_sessions() -> main.SessionStore:
+        store = main.SessionStore()
+        for i in range(count):
+            store.put(30_000_000 + i, main.VoterSession(f"S{i:07d}", i + 2, classes[i % len(classes)], main.WAITING_FOR_CONTACT))
+        return store
+
+    def build_user_data() -> Tuple[Dict[int, Dict[str, Any]], List[asyncio.TimerHandle]]:
+        # Колишній формат: словник user_data та окремий таймер тайм-ауту на кожну розмову
+        loop = asyncio.new_event_loop()
+        user_data, timers = {}, []
+        for i in range(count):
+            code = f"S{i:07d}"
+            user_data[30_000_000 + i] = {'code_row_index': i + 2, 'unique_code': code,
+                                         'code_info': {'Class': classes[i % len(classes)], 'Unique_Code': code}}
+            timers.append(loop.call_later(main.CONVERSATION_TIMEOUT, lambda: None))
+        loop.close()
+        return user_data, timers
+
+    session_bytes, session_seconds, store = traced(build_sessions)
+    legacy_bytes, legacy_seconds, _ = traced(build_user_data)
+    started = time.perf_counter()
+    evicted = store.advance(time.monotonic() + store.ttl + store.tick)
+    evict_seconds = time.perf_counter() - started
+    return {
+        'count': count,
+        'bytes_per_voter': round(session_bytes, 1),
+        'user_data_bytes_per_voter': round(legacy_bytes, 1),
+        'schedule_us': round(session_seconds * 1e6, 3),
+        'user_data_schedule_us': round(legacy_seconds * 1e6, 3),
+        'evict_us': round(evict_seconds * 1e6 / max(1, evicted), 3),
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# --- ЗАПУСК ---
+
+async def run_voter(client: TestClient, path: str, recorder: Recorder, index: int, code: str, candidate_key: str,
+                    election_id: str, webhook_latency: Dict[str, List[float]], rejected: Counter) -> bool:
+    """Проходить повний сценарій одного виборця. Повертає True, якщо всі кроки оброблено."""
+    user_id = 10_000_000 + index
+    for step, payload in voter_updates(index, code, candidate_key, election_id):
+        started = time.perf_counter()
+        while True:
+            async with client.post(path, json=payload) as resp:
+                status = resp.status
+            if status != 429:
+                break
+            # Backpressure: як і Telegram, повторюємо доставку трохи пізніше
+            rejected[step] += 1
+            await asyncio.sleep(0.05)
+        if status != 200:
+            return False
+        handled = await recorder.wait_handled(user_id)
+        webhook_latency[step].append(time.perf_counter() - started)
+        if handled != step:
+            return False
+    return True
+
+def bench_elections(count: int) -> List[main.Election]:
+    """Одні вибори за замовчуванням або count виборів з однаковими кандидатами та окремими таблицями."""
+    if count <= 1:
+        return main.load_elections('')
+    return [main.Election(f"bench-{i}", f"Бенчмарк {i}", f"Benchmark-{i}", main.CANDIDATES, main.CLASS_CONFIG)
+            for i in range(count)]
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='votebot-bench-')
+    elections = bench_elections(args.elections)
+    election_ids = [election.id for election in elections]
+
+    # Один клієнт Sheets API на всі вибори, як у main(); у кожних виборів своя таблиця
+    api = main.SheetsApiClient(args.sheets_quota, main.SHEETS_MAX_WORKERS)
+    spreadsheets: List[FakeSpreadsheet] = []
+    for i, election in enumerate(elections):
+        spreadsheet = FakeSpreadsheet(
+            {"Codes": make_codes(args.voters, i, len(elections)), "Votes": [list(main.VOTES_HEADER)]},
+            args.sheets_latency, args.sheets_error_rate, args.seed + i
+        )
+        spreadsheets.append(spreadsheet)
+        main.open_election_storage(election, api, args.storage, workdir)
+        election.sheets.sheet = spreadsheet
+        election.sheets.is_connected = True
+        if election.mirror:
+            await election.mirror.bootstrap()
+
+    def total_calls() -> int:
+        return sum(sum(spreadsheet.calls.values()) for spreadsheet in spreadsheets)
+
+    telegram = FakeTelegramRequest(args.telegram_latency)
+    application = main.build_application(BENCH_TOKEN, request=telegram)
+    application.bot_data['sheets_api'] = api
+    recorder = Recorder()
+    instrument_handlers(application, recorder)
+
+    startup_started = time.perf_counter()
+    await main.setup_bot_state(application, elections, shared_state_url=args.shared_state, data_dir=workdir)
+    await main.warm_up_caches(application)
+    startup_seconds = time.perf_counter() - startup_started
+    startup_calls = total_calls()
+    startup_cells = sum(spreadsheet.cells_read for spreadsheet in spreadsheets)
+    for spreadsheet in spreadsheets:
+        spreadsheet.calls.clear()
+
+    web_app = main.build_web_app(application, args.workers)
+    dispatcher: Optional[main.UpdateDispatcher] = web_app['update_dispatcher']
+    await application.initialize()
+    await application.start()
+    application.bot_data['readiness'].mark_ready()
+    if dispatcher:
+        dispatcher.start()
+
+    journal_tasks = [asyncio.create_task(main.vote_journal_flush_task(election.journal)) for election in elections]
+    mirror_tasks = [asyncio.create_task(main.mirror_sync_task(election.mirror)) for election in elections if election.mirror]
+
+    webhook_latency: Dict[str, List[float]] = defaultdict(list)
+    rejected: Counter = Counter()
+    candidates = list(main.CANDIDATES)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    path = f"/{BENCH_TOKEN}"
+
+    async with TestClient(TestServer(web_app)) as client:
+        async def voter(index: int, candidate_key: str) -> bool:
+            async with semaphore:
+                election_id = election_ids[index % len(election_ids)]
+                return await run_voter(client, path, recorder, index, f"B{index:07d}", candidate_key, election_id,
+                                       webhook_latency, rejected)
+
+        run_started = time.perf_counter()
+        results = await asyncio.gather(*[voter(i, rng.choice(candidates)) for i in range(args.voters)])
+        run_seconds = time.perf_counter() - run_started
+
+        # Сплеск непотрібних оновлень: скільки процесорного часу йде на один такий запит
+        spam: Dict[str, Any] = {}
+        if args.spam:
+            async def send_spam(payload: Dict[str, Any]) -> None:
+                async with semaphore:
+                    async with client.post(path, json=payload) as resp:
+                        await resp.read()
+
+            payloads = spam_updates(args.spam, args.voters, election_ids)
+            cpu_started, spam_started = time.process_time(), time.perf_counter()
+            await asyncio.gather(*[send_spam(payload) for payload in payloads])
+            webhook_filter: main.WebhookFilter = web_app['webhook_filter']
+            spam = {
+                'requests': len(payloads),
+                'seconds': round(time.perf_counter() - spam_started, 4),
+                'cpu_ms_per_request': round((time.process_time() - cpu_started) * 1000 / len(payloads), 4),
+                'dropped_irrelevant': webhook_filter.dropped_irrelevant,
+                'dropped_duplicate': webhook_filter.dropped_duplicate,
+            }
+
+        # Дочікуємося перенесення всіх голосів у Sheets, щоб порахувати реальну кількість викликів API
+        drain_started = time.perf_counter()
+        for task in journal_tasks + mirror_tasks:
+            task.cancel()
+        for election in elections:
+            await election.journal.flush()
+            if election.mirror:
+                storage = election.storage
+                while storage.dirty_rows("Votes", 1) or storage.dirty_rows("Codes", 1):
+                    await election.mirror.sync()
+        drain_seconds = time.perf_counter() - drain_started
+
+        if dispatcher:
+            await dispatcher.stop()
+        await application.stop()
+        await application.shutdown()
+    for election in elections:
+        election.journal.close()
+    api.shutdown()
+
+    completed = sum(results)
+    flow_calls = total_calls()
+    sheets_calls: Counter = sum((spreadsheet.calls for spreadsheet in spreadsheets), Counter())
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {key: value for key, value in vars(args).items() if key != 'json'},
+        'startup': {'seconds': round(startup_seconds, 4), 'sheets_calls': startup_calls, 'sheets_cells_read': startup_cells},
+        'voters_completed': completed,
+        'voters_failed': args.voters - completed,
+        'run_seconds': round(run_seconds, 4),
+        'drain_seconds': round(drain_seconds, 4),
+        'throughput_voters_per_s': round(completed / run_seconds, 2) if run_seconds else 0,
+        'sheets_calls': dict(sheets_calls),
+        'sheets_calls_per_vote': round(flow_calls / completed, 3) if completed else None,
+        'telegram_calls': dict(telegram.calls),
+        'rejected_429': dict(rejected),
+        'handlers': {name: percentiles(samples) for name, samples in sorted(recorder.latency.items())},
+        'webhook_steps': {name: percentiles(samples) for name, samples in webhook_latency.items()},
+        'votes_in_sheet': sum(len(spreadsheet._worksheets['Votes'].values) - 1 for spreadsheet in spreadsheets),
+        'spam': spam,
+        'sessions': measure_sessions(args.session_sample),
+    }
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"Коміт {report['commit']}, сховище: {report['params']['storage']}, воркерів: {report['params']['workers']}, "
+          f"виборів: {report['params']['elections']}")
+    print(f"Виборців: {report['voters_completed']} успішно, {report['voters_failed']} з помилками за {report['run_seconds']} с "
+          f"-> {report['throughput_voters_per_s']} виборців/с")
+    print(f"Старт: {report['startup']['seconds']} с, {report['startup']['sheets_calls']} викликів Sheets, "
+          f"{report['startup']['sheets_cells_read']} прочитаних клітинок")
+    print(f"Виклики Sheets на голос: {report['sheets_calls_per_vote']} {report['sheets_calls']}")
+    print(f"Голосів у вкладці Votes: {report['votes_in_sheet']}; відхилено з 429: {report['rejected_429'] or 0}")
+    sessions = report['sessions']
+    print(f"Сесії ({sessions['count']}): {sessions['bytes_per_voter']} Б на виборця (user_data: {sessions['user_data_bytes_per_voter']} Б), "
+          f"планування тайм-ауту {sessions['schedule_us']} мкс (user_data + таймер: {sessions['user_data_schedule_us']} мкс), "
+          f"видалення {sessions['evict_us']} мкс")
+    if report['spam']:
+        spam = report['spam']
+        print(f"Сплеск: {spam['requests']} непотрібних оновлень за {spam['seconds']} с, {spam['cpu_ms_per_request']} мс CPU на запит "
+              f"(відкинуто: {spam['dropped_irrelevant']} непотрібних, {spam['dropped_duplicate']} повторних)")
+    for title, section in (('Обробник', 'handlers'), ('Крок вебхука', 'webhook_steps')):
+        print(f"\n{title:<20} {'n':>6} {'p50 мс':>10} {'p95 мс':>10} {'p99 мс':>10} {'max мс':>10}")
+        for name, stats in report[section].items():
+            if stats['count']:
+                print(f"{name:<20} {stats['count']:>6} {stats['p50_ms']:>10} {stats['p95_ms']:>10} {stats['p99_ms']:>10} {stats['max_ms']:>10}")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк вебхука голосування з фейковими Telegram та Google Sheets.")
+    parser.add_argument('--voters', type=int, default=200, help="кількість віртуальних виборців")
+    parser.add_argument('--concurrency', type=int, default=20, help="скільки виборців голосують одночасно")
+    parser.add_argument('--workers', type=int, default=main.WEBHOOK_WORKERS, help="WEBHOOK_WORKERS (0 — обробка прямо у вебхуку)")
+    parser.add_argument('--elections', type=int, default=1, help="кількість виборів в одному процесі (виборці розподіляються між ними)")
+    parser.add_argument('--storage', choices=['sheets', 'sqlite'], default='sheets', help="основне сховище")
+    parser.add_argument('--sheets-latency', type=float, default=0.05, help="середня затримка виклику Sheets API, с")
+    parser.add_argument('--sheets-error-rate', type=float, default=0.0, help="частка викликів Sheets, що завершуються 429/503")
+    parser.add_argument('--sheets-quota', type=int, default=100_000, help="квота Sheets API, запитів/хв (реальна — 60)")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="затримка виклику Bot API, с")
+    parser.add_argument('--shared-state', default='', help="SHARED_STATE_URL (memory://, sqlite:///шлях) — режим кількох реплік")
+    parser.add_argument('--spam', type=int, default=0, help="після голосування надіслати стільки непотрібних/повторних оновлень")
+    parser.add_argument('--session-sample', type=int, default=10_000, help="скільки сесій створити для виміру пам'яті та тайм-аутів")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="дописати результат рядком JSON у цей файл")
+    parser.add_argument('--verbose', action='store_true', help="не приглушувати журнал бота")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('main').setLevel(logging.WARNING)
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
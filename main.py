@@ -1,9 +1,20 @@
 import os
 import asyncio
-import uuid
 import json
+import bisect
+import contextlib
+import inspect
 import logging
-from datetime import datetime
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from datetime import datetime, timedelta
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
@@ -11,16 +22,33 @@ from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, ContextTypes,
     CallbackQueryHandler, ConversationHandler
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import BaseRequest
 from aiohttp import web
 import aiohttp # Додаємо для коректної роботи ClientSession в keep_alive
-from typing import Dict, Any, List
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, Hashable, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+try:
+    import orjson  # Необов'язково: швидший розбір JSON у вебхуку
+except ImportError:
+    orjson = None
+
+try:
+    import redis.asyncio as aioredis  # Необов'язково: потрібен лише для SHARED_STATE_URL=redis://...
+except ImportError:
+    aioredis = None
+
+try:
+    import fcntl  # Немає у Windows: там каталог стану не блокується
+except ImportError:
+    fcntl = None
 
 # --- ВСТАНОВИТИ ЗАЛЕЖНОСТІ: pip install python-telegram-bot gspread oauth2client aiohttp requests ---
 
 # --- КОНФІГУРАЦІЯ СЕКРЕТІВ З RENDER (ТІЛЬКИ ДЛЯ БЕЗПЕЧНИХ КЛЮЧІВ) ---
 # Ці змінні будуть читатися з Render.
 GSPREAD_SECRET_JSON = os.environ.get("GSPREAD_SECRET_JSON", '{"type": "service_account", "placeholder": "PASTE YOUR FULL JSON HERE"}') # Секрет
-INITIAL_CODE_GENERATION = os.environ.get("INITIAL_CODE_GENERATION", 'FALSE').upper() # 'TRUE' або 'FALSE'
+INITIAL_CODE_GENERATION = os.environ.get("INITIAL_CODE_GENERATION", 'FALSE').upper() # 'TRUE' (з очищенням), 'APPEND' (дописати) або 'FALSE'
 
 # --- ОСНОВНА КОНФІГУРАЦІЯ БОТА (В КОДІ) ---
 # 🌟 Усі ці значення тепер жорстко задані в коді
@@ -28,6 +56,73 @@ TELEGRAM_BOT_TOKEN = "7710517859:AAFVhcHqe5LqAc98wLhRVrAEc8lW4XhgWuw" # ВАШ 
 WEBHOOK_BASE_URL = "https://school-voting-bot.onrender.com"  # ВАШ ОСНОВНИЙ URL RENDER
 SHEET_NAME = "School_Elections"  # НАЗВА ВАШОЇ ТАБЛИЦІ GOOGLE SHEETS
 KEEP_ALIVE_INTERVAL = 600  # 10 хвилин для Keep-Alive
+# Генерація кодів: алфавіт (без схожих символів 0/O, 1/I), довжина коду, розмір частини
+# завантаження та файл плану для відновлення перерваної генерації.
+# receive_code переводить введений код у верхній регістр, тож алфавіт теж (без повторів символів)
+CODE_ALPHABET = ''.join(dict.fromkeys(os.environ.get("CODE_ALPHABET", "ABCDEFGHJKLMNPQRSTUVWXYZ23456789").upper()))
+CODE_LENGTH = 8
+CODE_UPLOAD_CHUNK = 5000
+CODE_GENERATION_CHECKPOINT = os.environ.get("CODE_GENERATION_CHECKPOINT", "codes_generation.jsonl")
+# Скільки секунд обробники чекають на завершення фонового запуску (підключення до Sheets, прогрів кешів)
+READINESS_WAIT = 10
+# Обробка оновлень вебхука: скільки оновлень (різних користувачів) обробляються одночасно
+# (0 — обробляти прямо в HTTP-запиті) та місткість черги, після заповнення якої вебхук відповідає 429
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 64))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+# Скільки останніх update_id пам'ятати, щоб відкидати повторні доставки того самого оновлення
+WEBHOOK_DEDUP_SIZE = 10000
+# Квота Google Sheets API (запитів на хвилину), розмір пулу потоків та кількість повторів при 429/5xx
+SHEETS_QUOTA_PER_MINUTE = int(os.environ.get("SHEETS_QUOTA_PER_MINUTE", 60))
+SHEETS_MAX_WORKERS = int(os.environ.get("SHEETS_MAX_WORKERS", 4))
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_BASE = 1.0  # секунди
+SHEETS_BACKOFF_MAX = 32.0  # секунди
+# Тайм-аут розмови голосування (секунди); стільки ж живе резервування введеного коду
+CONVERSATION_TIMEOUT = 3600
+# Крок колеса таймерів, яке видаляє сесії розмов після CONVERSATION_TIMEOUT (точність видалення — один крок)
+SESSION_WHEEL_TICK = 10
+# Спільний стан для кількох реплік бота (розмови, резервування кодів, ключі ідемпотентності голосів):
+# '' — вимкнено (одна репліка), 'memory://', 'sqlite:///шлях/до/файлу.db' або 'redis://host:6379/0'
+SHARED_STATE_URL = os.environ.get("SHARED_STATE_URL", '')
+USER_LOCK_TTL = 30  # секунди, після яких блокування користувача знімається автоматично
+USER_LOCK_WAIT = 10  # секунди очікування блокування користувача, зайнятого іншою реплікою
+# Каталог локальних файлів стану (журнал голосів, черга резервного режиму, знімок кодів, розсилка, /live).
+# Кожна репліка на одному хості повинна мати власний каталог: друга репліка з тим самим каталогом не запуститься
+DATA_DIR = os.environ.get("DATA_DIR", '')
+# Резервний режим на час недоступності Google Sheets: локальний знімок вкладки 'Codes' (перезаписується
+# після кожного повного оновлення індексу) та черга реєстрацій, яка дозаписується після відновлення зв'язку
+CODE_SNAPSHOT_PATH = os.environ.get("CODE_SNAPSHOT_PATH", "codes_snapshot.tsv")
+OFFLINE_QUEUE_PATH = os.environ.get("OFFLINE_QUEUE_PATH", "offline_registrations.jsonl")
+OFFLINE_PROBE_INTERVAL = 15  # секунди між перевірками доступності Sheets у резервному режимі
+# Основне сховище: 'sheets' (Google Sheets) або 'sqlite' (локальна БД, Sheets стає асинхронним дзеркалом)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", 'sheets').lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "school_elections.db")
+MIRROR_SYNC_INTERVAL = 5  # секунди між пакетними синхронізаціями SQLite -> Google Sheets
+# Журнал голосів (write-behind): локальний файл, з якого голоси пакетно переносяться у вкладку 'Votes'
+VOTE_JOURNAL_PATH = os.environ.get("VOTE_JOURNAL_PATH", "votes_journal.jsonl")
+VOTE_FLUSH_INTERVAL = 2  # секунди між спробами перенесення
+VOTE_FLUSH_BATCH = 500  # максимум рядків в одному append_rows
+VOTE_JOURNAL_COMPACT_BYTES = 1024 * 1024  # після повного перенесення журнал більшого розміру обрізається
+# Індекс кодів у пам'яті: період фонового оновлення та максимально допустима «застарілість» (секунди)
+CODE_INDEX_REFRESH_INTERVAL = 60
+CODE_INDEX_MAX_AGE = 180
+# Мінімальний інтервал між позаплановими оновленнями індексу при введенні невідомого коду
+CODE_INDEX_MISS_REFRESH = 15
+# Розсилка повідомлень виборцям: глобальний ліміт Telegram ~30 повідомлень/с, не більше 1/с в один чат
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+BROADCAST_CHAT_INTERVAL = 1.0  # секунди між повторними спробами в той самий чат
+BROADCAST_WORKERS = 16
+BROADCAST_MAX_RETRIES = 3
+# Файл прогресу розсилки: після перезапуску незавершену розсилку можна продовжити (/broadcast resume)
+BROADCAST_STATE_PATH = os.environ.get("BROADCAST_STATE_PATH", "broadcast_state.jsonl")
+# Живі результати для адміністраторів (/live): не частіше одного редагування повідомлення за стільки секунд
+LIVE_RESULTS_INTERVAL = float(os.environ.get("LIVE_RESULTS_INTERVAL", 5))
+LIVE_RESULTS_PATH = os.environ.get("LIVE_RESULTS_PATH", "live_results.json")
+# Кілька виборів в одному процесі: шлях до JSON-файлу зі списком виборів
+# [{"id": "...", "title": "...", "sheet_name": "...", "candidates": {...}, "class_config": {...}}, ...].
+# Якщо не задано, проводяться одні вибори DEFAULT_ELECTION_ID з SHEET_NAME, CANDIDATES та CLASS_CONFIG нижче
+ELECTIONS_PATH = os.environ.get("ELECTIONS_PATH", '')
+DEFAULT_ELECTION_ID = 'school'
 # Render автоматично надає змінну PORT, але ми використовуємо 8080 як резерв
 PORT = 8080 
 
@@ -37,162 +132,2433 @@ ADMIN_IDS = [
     6484405296, # Ваш другий ID
 ]
 
-# Конфігурація класів для генерації кодів (Класи: Кількість учнів)
-CLASS_CONFIG = {
-    "7-А": 28,
-    "7-Б": 30,
-    "6-Б": 25,
-    "6-А": 27,
-    "6-В": 29
-}
+# Конфігурація класів для генерації кодів (Класи: Кількість учнів)
+CLASS_CONFIG = {
+    "7-А": 28,
+    "7-Б": 30,
+    "6-Б": 25,
+    "6-А": 27,
+    "6-В": 29
+}
+
+# Кандидати для голосування
+CANDIDATES = {
+    "Viktoriia Kochut": "Вікторія Кочут",
+    "Oleksandr Bilostotskyi": "Білостоцький Олександр",
+    "Yeva Baziuta": "Єва Базюта",
+    "Anna Strilchuk": "Анна Стрільчук"
+}
+
+# Підпис голосу за кандидата, якого немає в конфігурації виборів (або з порожньою клітинкою в 'Votes')
+UNKNOWN_CANDIDATE = "Невідомий кандидат"
+
+# Структура вкладок таблиці
+CODES_HEADER = ['Class', 'Student_Count', 'Unique_Code', 'Is_Used', 'Telegram_ID', 'Phone_Number', 'Full_Name']
+VOTES_HEADER = ['Timestamp', 'Class', 'Unique_Code', 'Telegram_ID', 'Username', 'Full_Name', 'Candidate_Voted']
+TAB_HEADERS = {"Codes": CODES_HEADER, "Votes": VOTES_HEADER}
+
+# Стани розмови голосування (VoterSession.state); ConversationHandler.END — розмову завершено
+(WAITING_FOR_CODE, WAITING_FOR_CONTACT, WAITING_FOR_VOTE) = range(3)
+
+# --- ЛОГУВАННЯ ---
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# --- МЕТРИКИ (ФОРМАТ PROMETHEUS) ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EVENT_LOOP_LAG_INTERVAL = 0.5  # секунди між вимірюваннями затримки циклу подій
+
+class Histogram:
+    """Гістограма з однією міткою. observe() — бінарний пошук по кошиках, без блокувань."""
+    def __init__(self, name: str, help_text: str, label: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series: Dict[str, List[float]] = {}  # значення мітки -> [лічильники кошиків..., сума, кількість]
+
+    def observe(self, label_value: str, value: float) -> None:
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0.0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative:g}')
+            lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {series[-1]:g}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series[-1]:g}')
+        return lines
+
+class MetricsRegistry:
+    """Реєстр метрик: гістограми оновлюються на гарячому шляху, значення gauge обчислюються при запиті /metrics."""
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], Union[float, Awaitable[float]]]]] = {}
+
+    def histogram(self, name: str, help_text: str, label: str) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help_text, label)
+        return self.histograms[name]
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], Union[float, Awaitable[float]]]) -> None:
+        """Реєструє (або замінює) gauge, значення якого повертає collect() (число або корутина)."""
+        self.gauges[name] = (help_text, collect)
+
+    async def render(self) -> str:
+        lines: List[str] = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        for name, (help_text, collect) in self.gauges.items():
+            try:
+                value = collect()
+                if inspect.isawaitable(value):
+                    value = await value
+            except Exception as e:
+                logger.warning(f"⚠️ Не вдалося обчислити метрику {name}: {e}")
+                continue
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"])
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+HANDLER_LATENCY = METRICS.histogram('votebot_handler_duration_seconds', 'Час виконання обробників Telegram.', 'handler')
+SHEETS_LATENCY = METRICS.histogram('votebot_sheets_call_duration_seconds', 'Час виконання методів сховища.', 'method')
+EVENT_LOOP_LAG = METRICS.histogram('votebot_event_loop_lag_seconds', 'Запізнення циклу подій відносно запланованого пробудження.', 'loop')
+
+def instrumented(callback: Callable) -> Callable:
+    """Обгортка обробника Telegram: гістограма часу виконання."""
+    @wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_LATENCY.observe(callback.__name__, time.perf_counter() - started)
+    return wrapper
+
+def timed_storage_call(method: Callable) -> Callable:
+    """Обгортка методу сховища: гістограма часу виконання з міткою назви методу."""
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            SHEETS_LATENCY.observe(method.__name__, time.perf_counter() - started)
+    return wrapper
+
+async def event_loop_lag_task(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    """Фонова задача: вимірює, наскільки пізніше запланованого прокидається цикл подій."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe('main', max(0.0, loop.time() - expected))
+
+# --- СХОВИЩЕ ДАНИХ ---
+class StorageBackend(ABC):
+    """Спільний інтерфейс сховища вкладок 'Codes' та 'Votes' (рядки й колонки нумеруються з 1, як у Sheets)."""
+    is_connected = False
+
+    def invalidate(self, title: Optional[str] = None) -> None:
+        """Скидає кешовані метадані вкладки (якщо сховище їх кешує)."""
+
+    def observe_header(self, title: str, header: List[Any]) -> None:
+        """Отримує рядок заголовків, прочитаний іншим запитом (якщо сховище кешує заголовки)."""
+
+    @abstractmethod
+    async def get_columns(self, worksheet_title: str, names: List[str]) -> Optional[Dict[str, int]]:
+        ...
+
+    @abstractmethod
+    async def get_all_records(self, worksheet_title: str) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def get_all_values(self, worksheet_title: str) -> List[List[Any]]:
+        ...
+
+    @abstractmethod
+    async def read_columns(self, worksheet_title: str, names: List[str], start_row: int = 2) -> Optional[List[List[Any]]]:
+        """Рядки вкладки, починаючи з start_row, лише з колонками names (у цьому порядку). None — помилка читання."""
+
+    @abstractmethod
+    async def update_cell(self, worksheet_title: str, row: int, col: int, value: Any) -> bool:
+        ...
+
+    @abstractmethod
+    async def update_row_fields(self, worksheet_title: str, row: int, fields: Dict[Union[str, int], Any]) -> bool:
+        ...
+
+    @abstractmethod
+    async def append_row(self, worksheet_title: str, values: List[Any]) -> bool:
+        ...
+
+    @abstractmethod
+    async def append_rows(self, worksheet_title: str, rows: List[List[Any]]) -> bool:
+        ...
+
+# --- КЛІЄНТ GOOGLE SHEETS API: ОБМЕЖЕННЯ КВОТИ, ПОВТОРИ, ОБ'ЄДНАННЯ ЗАПИТІВ ---
+class TokenBucket:
+    """Відро токенів: не більше rate запитів на секунду з допустимим сплеском capacity."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class SheetsApiClient:
+    """Спільний для всіх виборів клієнт gspread з квотою, повторами та об'єднанням однакових читань."""
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, quota_per_minute: int = SHEETS_QUOTA_PER_MINUTE, max_workers: int = SHEETS_MAX_WORKERS,
+                 max_retries: int = SHEETS_MAX_RETRIES):
+        self.bucket = TokenBucket(quota_per_minute / 60, max(1, quota_per_minute // 10))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+        self.max_retries = max_retries
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.in_flight_calls = 0
+        # Виклики, передані в пул потоків, але ще не розпочаті (зменшується в потоці пулу)
+        self.queued_calls = 0
+        self._queued_lock = threading.Lock()
+        # Авторизовані клієнти gspread (одна HTTP-сесія й токен доступу на кожен набір облікових даних)
+        self._clients: Dict[str, Any] = {}
+        self._clients_lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        """Кількість викликів, що чекають на вільний потік у пулі."""
+        return self.queued_calls
+
+    async def _run_in_pool(self, fn: Callable, *args, **kwargs) -> Any:
+        started = False
+
+        def run() -> Any:
+            nonlocal started
+            with self._queued_lock:
+                started = True
+                self.queued_calls -= 1
+            return fn(*args, **kwargs)
+
+        with self._queued_lock:
+            self.queued_calls += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        finally:
+            # Скасований до початку виклик так і не потрапив у потік
+            with self._queued_lock:
+                if not started:
+                    started = True
+                    self.queued_calls -= 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def authorize_sync(self, json_creds_str: str) -> Any:
+        """Клієнт gspread, спільний для всіх таблиць (виборів) з тими самими обліковими даними (блокуючий виклик)."""
+        with self._clients_lock:
+            client = self._clients.get(json_creds_str)
+            if client is None:
+                # 1. Розпарсити JSON-рядок на Python словник
+                creds_dict = json.loads(json_creds_str)
+                # 2. Використовувати словник для авторизації
+                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+                creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+                client = self._clients[json_creds_str] = gspread.authorize(creds)
+            return client
+
+    async def call(self, fn: Callable, *args, coalesce_key: Optional[Hashable] = None, idempotent: bool = True, **kwargs) -> Any:
+        """Виконує виклик gspread з урахуванням квоти та повторів."""
+        if coalesce_key is None:
+            return await self._call_with_retry(fn, *args, idempotent=idempotent, **kwargs)
+
+        inflight = self._inflight.get(coalesce_key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._call_with_retry(fn, *args, idempotent=idempotent, **kwargs))
+            self._inflight[coalesce_key] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(coalesce_key, None))
+        # shield: скасування одного з очікувачів не скасовує спільний запит для інших
+        return await asyncio.shield(inflight)
+
+    async def _call_with_retry(self, fn: Callable, *args, idempotent: bool = True, **kwargs) -> Any:
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.in_flight_calls += 1
+            try:
+                return await self._run_in_pool(fn, *args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = getattr(e.response, 'status_code', None)
+                # Неідемпотентні виклики (додавання рядків) після 5xx могли вже застосуватися — повторюємо лише 429
+                retryable = status == 429 or (idempotent and status in self.RETRY_STATUSES)
+                if not retryable or attempt == self.max_retries:
+                    raise
+                reason = f"HTTP {status}"
+            except OSError as e:
+                # Мережеві збої (у т.ч. requests.ConnectionError) теж тимчасові
+                if not idempotent or attempt == self.max_retries:
+                    raise
+                reason = str(e)
+            finally:
+                self.in_flight_calls -= 1
+            delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+            logger.warning(f"⚠️ Sheets API: {reason} у {getattr(fn, '__name__', fn)}, повтор {attempt + 1}/{self.max_retries} через {delay:.1f} с.")
+            await asyncio.sleep(delay)
+
+# --- МЕНЕДЖЕР GOOGLE SHEETS (GSPREAD) ---
+class SheetsManager(StorageBackend):
+    """Клас для безпечної взаємодії з Google Sheets через gspread."""
+    def __init__(self, json_creds_str: str, sheet_name: str, api: Optional[SheetsApiClient] = None):
+        self.sheet_name = sheet_name
+        self.api = api or SheetsApiClient()
+        self.is_connected = False
+        self.client = None
+        self.sheet = None
+        # Кеш об'єктів вкладок та відповідностей «назва заголовка -> номер колонки» для кожної вкладки
+        self._worksheets: Dict[str, Any] = {}
+        self._headers: Dict[str, Dict[str, int]] = {}
+        # Відкладені оновлення клітинок для кожної вкладки: (діапазони batch_update, future результату)
+        self._pending_writes: Dict[str, List[Tuple[List[Dict[str, Any]], asyncio.Future]]] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+
+        self._json_creds_str = json_creds_str
+
+    def _connect_sync(self) -> None:
+        """Авторизація та відкриття таблиці (блокуючі виклики gspread)."""
+        # Авторизований клієнт спільний для всіх таблиць, що працюють через цей клієнт API
+        self.client = self.api.authorize_sync(self._json_creds_str)
+
+        # Відкрити таблицю
+        self.sheet = self.client.open(self.sheet_name)
+
+    async def connect(self) -> bool:
+        """Підключається до Google Sheets у пулі потоків клієнта API, не блокуючи цикл подій."""
+        if not (self._json_creds_str and self.sheet_name):
+            return False
+        try:
+            await self.api.call(self._connect_sync)
+            self.is_connected = True
+            logger.info(f"✅ Успішне підключення до Google Sheets ('{self.sheet_name}').")
+        except Exception as e:
+            # Змінюємо логування для більшої інформативності
+            logger.error(f"❌ Критична помилка підключення до Google Sheets. Перевірте GSPREAD_SECRET_JSON, права доступу та назву таблиці '{self.sheet_name}'. Деталі: {e}")
+            self.is_connected = False
+        return self.is_connected
+
+    def invalidate(self, title: Optional[str] = None) -> None:
+        """Скидає кеш вкладки та її заголовків (або всіх вкладок, якщо title не задано)."""
+        if title is None:
+            self._worksheets.clear()
+            self._headers.clear()
+        else:
+            self._worksheets.pop(title, None)
+            self._headers.pop(title, None)
+
+    def observe_header(self, title: str, header: List[Any]) -> None:
+        """Оновлює кеш заголовків рядком, прочитаним іншим запитом (наприклад, get_all_values)."""
+        header_map = {name: i + 1 for i, name in enumerate(header) if name}
+        cached = self._headers.get(title)
+        if cached is not None and cached != header_map:
+            logger.warning(f"⚠️ Змінилася структура вкладки '{title}'. Скидаю кеш.")
+            self.invalidate(title)
+        self._headers[title] = header_map
+
+    @timed_storage_call
+    async def get_worksheet(self, title: str):
+        """Отримує робочий лист (вкладку) за назвою. Об'єкт вкладки кешується."""
+        if not self.is_connected: return None
+        ws = self._worksheets.get(title)
+        if ws is not None: return ws
+        try:
+            ws = await self.api.call(self.sheet.worksheet, title)
+            self._worksheets[title] = ws
+            return ws
+        except gspread.WorksheetNotFound:
+            logger.error(f"❌ Критична помилка: Вкладка '{title}' не знайдена в таблиці '{self.sheet_name}'. Перевірте назви вкладок ('Codes' та 'Votes').")
+            return None
+        except Exception as e:
+            logger.error(f"❌ Помилка при отриманні вкладки '{title}': {e}")
+            return None
+
+    @timed_storage_call
+    async def get_header_map(self, worksheet_title: str) -> Dict[str, int]:
+        """Повертає відповідність «назва заголовка -> номер колонки» (з 1). Результат кешується."""
+        header_map = self._headers.get(worksheet_title)
+        if header_map is not None: return header_map
+        ws = await self.get_worksheet(worksheet_title)
+        if ws is None: return {}
+        try:
+            header = await self.api.call(ws.row_values, 1, coalesce_key=(self.sheet_name, 'row_values', worksheet_title, 1))
+        except Exception as e:
+            logger.error(f"❌ Помилка читання заголовків з '{worksheet_title}': {e}")
+            return {}
+        self.observe_header(worksheet_title, header)
+        return self._headers[worksheet_title]
+
+    async def get_columns(self, worksheet_title: str, names: List[str]) -> Optional[Dict[str, int]]:
+        """Повертає номери колонок для заданих заголовків."""
+        for attempt in range(2):
+            header_map = await self.get_header_map(worksheet_title)
+            missing = [name for name in names if name not in header_map]
+            if not missing:
+                return {name: header_map[name] for name in names}
+            if attempt == 0:
+                logger.warning(f"⚠️ У кеші заголовків '{worksheet_title}' немає колонок {missing}. Перечитую схему.")
+                self.invalidate(worksheet_title)
+        logger.error(f"❌ У вкладці '{worksheet_title}' відсутні колонки: {missing}")
+        return None
+
+    @timed_storage_call
+    async def get_all_records(self, worksheet_title: str) -> List[Dict[str, Any]]:
+        """Отримує всі записи з робочого листа."""
+        ws = await self.get_worksheet(worksheet_title)
+        if ws is None: return []
+        try:
+            return await self.api.call(ws.get_all_records, coalesce_key=(self.sheet_name, 'get_all_records', worksheet_title))
+        except Exception as e:
+            logger.error(f"❌ Помилка читання даних з '{worksheet_title}': {e}")
+            return []
+
+    @timed_storage_call
+    async def update_cell(self, worksheet_title: str, row: int, col: int, value: Any):
+        """Оновлює одну клітинку."""
+        ws = await self.get_worksheet(worksheet_title)
+        if ws is None: return False
+        try:
+            await self.api.call(ws.update_cell, row, col, value)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Помилка оновлення клітинки в '{worksheet_title}' (R{row}, C{col}): {e}")
+            return False
+
+    @timed_storage_call
+    async def update_row_fields(self, worksheet_title: str, row: int, fields: Dict[Union[str, int], Any]) -> bool:
+        """Оновлює кілька клітинок одного рядка одним запитом batch_update."""
+        names = [col for col in fields if isinstance(col, str)]
+        columns = await self.get_columns(worksheet_title, names) if names else {}
+        if columns is None: return False
+
+        data = []
+        for col, value in fields.items():
+            col_num = columns[col] if isinstance(col, str) else col
+            data.append({'range': gspread.utils.rowcol_to_a1(row, col_num), 'values': [[value]]})
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending_writes.setdefault(worksheet_title, []).append((data, future))
+        if worksheet_title not in self._flush_tasks:
+            self._flush_tasks[worksheet_title] = asyncio.create_task(self._flush_row_updates(worksheet_title))
+        return await future
+
+    async def _flush_row_updates(self, worksheet_title: str) -> None:
+        """Відправляє накопичені оновлення вкладки одним batch_update, доки вони надходять."""
+        try:
+            while self._pending_writes.get(worksheet_title):
+                pending = self._pending_writes.pop(worksheet_title)
+                data = [item for ranges, _ in pending for item in ranges]
+                success = False
+                ws = await self.get_worksheet(worksheet_title)
+                if ws is not None:
+                    try:
+                        await self.api.call(ws.batch_update, data, value_input_option='USER_ENTERED')
+                        success = True
+                    except Exception as e:
+                        logger.error(f"❌ Помилка пакетного оновлення '{worksheet_title}' ({len(pending)} рядків): {e}")
+
+                for _, future in pending:
+                    if not future.done():
+                        future.set_result(success)
+        finally:
+            self._flush_tasks.pop(worksheet_title, None)
+
+    @timed_storage_call
+    async def append_row(self, worksheet_title: str, values: List[Any]):
+        """Додає новий рядок."""
+        ws = await self.get_worksheet(worksheet_title)
+        if ws is None: return False
+        try:
+            await self.api.call(ws.append_row, values, idempotent=False)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Помилка додавання рядка до '{worksheet_title}': {e}")
+            return False
+            
+    @timed_storage_call
+    async def append_rows(self, worksheet_title: str, rows: List[List[Any]]) -> bool:
+        """Додає кілька рядків одним запитом."""
+        ws = await self.get_worksheet(worksheet_title)
+        if ws is None: return False
+        try:
+            await self.api.call(ws.append_rows, rows, idempotent=False)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Помилка пакетного додавання {len(rows)} рядків до '{worksheet_title}': {e}")
+            return False
+
+    @timed_storage_call
+    async def get_all_values(self, worksheet_title: str) -> List[List[Any]]:
+        """Отримує всі значення (включаючи заголовки) з робочого листа."""
+        ws = await self.get_worksheet(worksheet_title)
+        if ws is None: return []
+        try:
+            return await self.api.call(ws.get_all_values, coalesce_key=(self.sheet_name, 'get_all_values', worksheet_title))
+        except Exception as e:
+            logger.error(f"❌ Помилка читання всіх значень з '{worksheet_title}': {e}")
+            return []
+
+    @timed_storage_call
+    async def read_columns(self, worksheet_title: str, names: List[str], start_row: int = 2) -> Optional[List[List[Any]]]:
+        """Читає лише колонки names з рядка start_row до кінця вкладки."""
+        for attempt in range(2):
+            columns = await self.get_columns(worksheet_title, names)
+            if columns is None: return None
+            ws = await self.get_worksheet(worksheet_title)
+            if ws is None: return None
+
+            ranges = []
+            for name in names:
+                letter = gspread.utils.rowcol_to_a1(1, columns[name])[:-1]
+                ranges += [f"{letter}1", f"{letter}{start_row}:{letter}"]
+            try:
+                result = await self.api.call(ws.batch_get, ranges, major_dimension='COLUMNS',
+                                             coalesce_key=(self.sheet_name, 'batch_get', worksheet_title, tuple(ranges)))
+            except gspread.exceptions.APIError as e:
+                # Діапазон, що починається після останнього рядка сітки (сітка закінчується на останньому
+                # рядку даних після append_rows), — це просто відсутність нових рядків
+                if start_row > 2 and 'exceeds grid limits' in str(e):
+                    return []
+                logger.error(f"❌ Помилка читання колонок {names} з '{worksheet_title}': {e}")
+                return None
+            except Exception as e:
+                logger.error(f"❌ Помилка читання колонок {names} з '{worksheet_title}': {e}")
+                return None
+
+            headers = [value_range[0][0] if value_range and value_range[0] else '' for value_range in result[0::2]]
+            if headers == list(names):
+                # Порожні клітинки в кінці колонки API не повертає — вирівнюємо колонки до спільної висоти
+                column_values = [value_range[0] if value_range else [] for value_range in result[1::2]]
+                height = max((len(values) for values in column_values), default=0)
+                return [[values[i] if i < len(values) else '' for values in column_values] for i in range(height)]
+
+            logger.warning(f"⚠️ Змінилася структура вкладки '{worksheet_title}': очікувались {names}, отримано {headers}.")
+            self.invalidate(worksheet_title)
+        return None
+
+# --- ЛОКАЛЬНЕ СХОВИЩЕ SQLITE ---
+class SqliteStorage(StorageBackend):
+    """Локальне сховище вкладок 'Codes' та 'Votes' у SQLite."""
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for title, header in TAB_HEADERS.items():
+            columns = ", ".join(f'"{name}" TEXT NOT NULL DEFAULT \'\'' for name in header)
+            # _sync: 0 — синхронізовано з Sheets, N > 0 — версія незбереженої зміни, -1 — відправка голосу не підтверджена
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{title}" (row INTEGER PRIMARY KEY, {columns}, _sync INTEGER NOT NULL DEFAULT 0)')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{title}_sync" ON "{title}" (_sync) WHERE _sync != 0')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_code ON "Codes" ("Unique_Code")')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_votes_code ON "Votes" ("Unique_Code")')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_votes_candidate ON "Votes" ("Candidate_Voted")')
+        self.is_connected = True
+        logger.info(f"✅ Локальне сховище SQLite відкрито: '{path}'.")
+
+    def close(self) -> None:
+        self.conn.close()
+        self.is_connected = False
+
+    @staticmethod
+    def _header(title: str) -> List[str]:
+        header = TAB_HEADERS.get(title)
+        if header is None:
+            raise KeyError(f"Невідома вкладка '{title}'")
+        return header
+
+    def _select_columns(self, title: str) -> str:
+        return ", ".join(f'"{name}"' for name in self._header(title))
+
+    def count_rows(self, title: str) -> int:
+        return self.conn.execute(f'SELECT COUNT(*) FROM "{title}"').fetchone()[0]
+
+    async def get_columns(self, worksheet_title: str, names: List[str]) -> Optional[Dict[str, int]]:
+        header = self._header(worksheet_title)
+        missing = [name for name in names if name not in header]
+        if missing:
+            logger.error(f"❌ У вкладці '{worksheet_title}' відсутні колонки: {missing}")
+            return None
+        return {name: header.index(name) + 1 for name in names}
+
+    async def get_all_values(self, worksheet_title: str) -> List[List[Any]]:
+        rows = self.conn.execute(f'SELECT {self._select_columns(worksheet_title)} FROM "{worksheet_title}" ORDER BY row').fetchall()
+        return [list(self._header(worksheet_title))] + [list(row) for row in rows]
+
+    async def read_columns(self, worksheet_title: str, names: List[str], start_row: int = 2) -> Optional[List[List[Any]]]:
+        if await self.get_columns(worksheet_title, names) is None:
+            return None
+        select = ", ".join(f'"{name}"' for name in names)
+        rows = self.conn.execute(f'SELECT {select} FROM "{worksheet_title}" WHERE row >= ? ORDER BY row', (start_row,)).fetchall()
+        return [list(row) for row in rows]
+
+    async def get_all_records(self, worksheet_title: str) -> List[Dict[str, Any]]:
+        header = self._header(worksheet_title)
+        rows = self.conn.execute(f'SELECT {self._select_columns(worksheet_title)} FROM "{worksheet_title}" ORDER BY row').fetchall()
+        return [dict(zip(header, row)) for row in rows]
+
+    async def update_cell(self, worksheet_title: str, row: int, col: int, value: Any) -> bool:
+        return await self.update_row_fields(worksheet_title, row, {col: value})
+
+    async def update_row_fields(self, worksheet_title: str, row: int, fields: Dict[Union[str, int], Any]) -> bool:
+        header = self._header(worksheet_title)
+        try:
+            names = [col if isinstance(col, str) else header[col - 1] for col in fields]
+            assignments = ", ".join(f'"{name}" = ?' for name in names)
+            values = [str(value) for value in fields.values()]
+            with self.conn:
+                cursor = self.conn.execute(
+                    f'UPDATE "{worksheet_title}" SET {assignments}, _sync = ABS(_sync) + 1 WHERE row = ?',
+                    values + [row]
+                )
+            return cursor.rowcount == 1
+        except (sqlite3.Error, IndexError) as e:
+            logger.error(f"❌ Помилка оновлення рядка {row} у SQLite '{worksheet_title}': {e}")
+            return False
+
+    async def append_row(self, worksheet_title: str, values: List[Any]) -> bool:
+        return await self.append_rows(worksheet_title, [values])
+
+    async def append_rows(self, worksheet_title: str, rows: List[List[Any]], synced: bool = False) -> bool:
+        header = self._header(worksheet_title)
+        placeholders = ", ".join("?" for _ in header)
+        try:
+            with self.conn:
+                next_row = self.conn.execute(f'SELECT COALESCE(MAX(row), 1) FROM "{worksheet_title}"').fetchone()[0] + 1
+                self.conn.executemany(
+                    f'INSERT INTO "{worksheet_title}" (row, {self._select_columns(worksheet_title)}, _sync) VALUES (?, {placeholders}, ?)',
+                    [
+                        [next_row + i] + [str(v) for v in (list(values) + [''] * len(header))[:len(header)]] + [0 if synced else 1]
+                        for i, values in enumerate(rows)
+                    ]
+                )
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"❌ Помилка додавання {len(rows)} рядків у SQLite '{worksheet_title}': {e}")
+            return False
+
+    def import_values(self, worksheet_title: str, values: List[List[Any]]) -> None:
+        """Замінює вміст таблиці даними з Google Sheets (рядки зберігають свої номери)."""
+        header = self._header(worksheet_title)
+        sheet_header = values[0] if values else []
+        positions = [sheet_header.index(name) if name in sheet_header else None for name in header]
+        placeholders = ", ".join("?" for _ in header)
+        with self.conn:
+            self.conn.execute(f'DELETE FROM "{worksheet_title}"')
+            self.conn.executemany(
+                f'INSERT INTO "{worksheet_title}" (row, {self._select_columns(worksheet_title)}) VALUES (?, {placeholders})',
+                [
+                    [i + 2] + [str(row[pos]) if pos is not None and pos < len(row) else '' for pos in positions]
+                    for i, row in enumerate(values[1:])
+                ]
+            )
+
+    def dirty_rows(self, worksheet_title: str, limit: int) -> List[Tuple[int, int, List[str]]]:
+        """Повертає до limit несинхронізованих рядків: (номер рядка, версія _sync, значення)."""
+        rows = self.conn.execute(
+            f'SELECT row, _sync, {self._select_columns(worksheet_title)} FROM "{worksheet_title}" WHERE _sync != 0 ORDER BY row LIMIT ?',
+            (limit,)
+        ).fetchall()
+        return [(row[0], row[1], list(row[2:])) for row in rows]
+
+    def set_sync_state(self, worksheet_title: str, rows: List[Tuple[int, int]], state: int) -> None:
+        """Встановлює _sync = state для рядків, версія яких не змінилась з моменту читання."""
+        with self.conn:
+            self.conn.executemany(
+                f'UPDATE "{worksheet_title}" SET _sync = ? WHERE row = ? AND _sync = ?',
+                [(state, row, version) for row, version in rows]
+            )
+
+class SheetsMirror:
+    """Фонове дзеркало змін SQLite у Google Sheets."""
+    def __init__(self, local: SqliteStorage, sheets: SheetsManager):
+        self.local = local
+        self.sheets = sheets
+        self._lock = asyncio.Lock()
+
+    async def bootstrap(self) -> None:
+        """Заповнює порожню локальну БД вмістом Google Sheets (перший запуск у режимі sqlite)."""
+        if not self.sheets.is_connected:
+            return
+        for title in TAB_HEADERS:
+            if self.local.count_rows(title) > 0:
+                continue
+            values = await self.sheets.get_all_values(title)
+            if values:
+                self.local.import_values(title, values)
+                logger.info(f"SQLite: імпортовано {len(values) - 1} рядків з вкладки '{title}'.")
+
+    async def sync(self) -> None:
+        """Відправляє в Google Sheets усі локальні зміни, накопичені з попередньої синхронізації."""
+        if not self.sheets.is_connected:
+            return
+        async with self._lock:
+            await self._sync_codes()
+            await self._sync_votes()
+
+    async def _sync_codes(self) -> None:
+        dirty = self.local.dirty_rows("Codes", VOTE_FLUSH_BATCH)
+        if not dirty: return
+        results = await asyncio.gather(*[
+            self.sheets.update_row_fields("Codes", row, dict(zip(CODES_HEADER, values)))
+            for row, _, values in dirty
+        ])
+        synced = [(row, version) for (row, version, _), ok in zip(dirty, results) if ok]
+        self.local.set_sync_state("Codes", synced, 0)
+        logger.info(f"Дзеркало Sheets: синхронізовано {len(synced)} з {len(dirty)} рядків 'Codes'.")
+
+    async def _sync_votes(self) -> None:
+        dirty = self.local.dirty_rows("Votes", VOTE_FLUSH_BATCH)
+        if not dirty: return
+
+        unconfirmed = [(row, version) for row, version, _ in dirty if version == -1]
+        if unconfirmed:
+            votes_keys = await self.sheets.read_columns("Votes", ['Timestamp', 'Unique_Code'])
+            if votes_keys is None: return
+            sheet_keys = {(r[0], r[1]) for r in votes_keys}
+            applied = [(row, version) for row, version, values in dirty if version == -1 and (values[0], values[2]) in sheet_keys]
+            self.local.set_sync_state("Votes", applied, 0)
+            self.local.set_sync_state("Votes", [item for item in unconfirmed if item not in applied], 1)
+            dirty = self.local.dirty_rows("Votes", VOTE_FLUSH_BATCH)
+            if not dirty: return
+
+        self.local.set_sync_state("Votes", [(row, version) for row, version, _ in dirty], -1)
+        if await self.sheets.append_rows("Votes", [values for _, _, values in dirty]):
+            self.local.set_sync_state("Votes", [(row, -1) for row, _, _ in dirty], 0)
+            logger.info(f"Дзеркало Sheets: додано {len(dirty)} голосів у вкладку 'Votes'.")
+
+async def mirror_sync_task(mirror: SheetsMirror):
+    """Фонова задача: пакетно синхронізує локальну БД SQLite з Google Sheets."""
+    while True:
+        await asyncio.sleep(MIRROR_SYNC_INTERVAL)
+        try:
+            await mirror.sync()
+        except Exception as e:
+            logger.error(f"❌ Помилка синхронізації SQLite -> Google Sheets: {e}")
+
+# --- ІНДЕКС КОДІВ У ПАМ'ЯТІ ---
+class CodeEntry(NamedTuple):
+    """Запис індексу кодів: номер рядка у вкладці 'Codes', клас та статус використання."""
+    row: int
+    class_name: str
+    is_used: bool
+
+class CodeIndex:
+    """Індекс Unique_Code -> (номер рядка, клас, Is_Used) для вкладки 'Codes'."""
+    # Колонки вкладки 'Codes', потрібні індексу (читаються лише вони)
+    COLUMNS = ['Unique_Code', 'Is_Used', 'Class']
+
+    def __init__(self, manager: StorageBackend, max_age: float = CODE_INDEX_MAX_AGE, snapshot_path: Optional[str] = None):
+        self.manager = manager
+        self.max_age = max_age
+        # Файл знімка індексу: перезаписується після кожного повного оновлення, читається при старті
+        self.snapshot_path = snapshot_path
+        self._entries: Dict[str, CodeEntry] = {}
+        self._loaded_at: Optional[float] = None
+        # Номер останнього прочитаного рядка та час останнього читання (повного чи лише нових рядків)
+        self._last_row = 1
+        self._read_at: Optional[float] = None
+        self._refresh_lock = asyncio.Lock()
+        # Коди, позначені ботом як використані: code -> час позначки (monotonic).
+        # Потрібні, щоб оновлення, розпочате до запису, не «відкотило» його у пам'яті.
+        self._local_marks: Dict[str, float] = {}
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    @property
+    def age(self) -> float:
+        if self._loaded_at is None: return float('inf')
+        return time.monotonic() - self._loaded_at
+
+    @property
+    def is_stale(self) -> bool:
+        return self.age > self.max_age
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def read_age(self) -> float:
+        """Час з останнього читання таблиці (повного або лише нових рядків)."""
+        if self._read_at is None: return float('inf')
+        return time.monotonic() - self._read_at
+
+    @staticmethod
+    def _parse(rows: List[List[Any]], start_row: int) -> Dict[str, CodeEntry]:
+        entries: Dict[str, CodeEntry] = {}
+        for i, (code, is_used, class_name) in enumerate(rows):
+            code = str(code).strip().upper()
+            if not code: continue
+            entries[code] = CodeEntry(start_row + i, class_name, str(is_used).upper() == 'TRUE')
+        return entries
+
+    async def refresh(self) -> bool:
+        """Повністю перечитує вкладку 'Codes' і перебудовує індекс. Повертає True у разі успіху."""
+        async with self._refresh_lock:
+            started = time.monotonic()
+            rows = await self.manager.read_columns("Codes", self.COLUMNS)
+            if rows is None:
+                logger.warning("Індекс кодів: не вдалося прочитати вкладку 'Codes', залишаю попередні дані.")
+                return False
+
+            # Рядок 2 — перший після заголовків (індексація gspread починається з 1)
+            entries = self._parse(rows, 2)
+
+            # Повторно застосовуємо позначки, зроблені ботом після початку читання
+            for code, marked_at in list(self._local_marks.items()):
+                if marked_at >= started and code in entries:
+                    entries[code] = entries[code]._replace(is_used=True)
+                elif marked_at < started:
+                    del self._local_marks[code]
+
+            self._entries = entries
+            self._last_row = 1 + len(rows)
+            self._loaded_at = self._read_at = time.monotonic()
+            logger.info(f"Індекс кодів оновлено: {len(entries)} кодів.")
+        if self.snapshot_path:
+            try:
+                await asyncio.to_thread(self._write_snapshot_sync, self.snapshot_path, list(self._entries.items()), self._last_row)
+            except OSError as e:
+                logger.error(f"❌ Не вдалося зберегти знімок індексу кодів '{self.snapshot_path}': {e}")
+        return True
+
+    @staticmethod
+    def _write_snapshot_sync(path: str, entries: List[Tuple[str, CodeEntry]], last_row: int) -> None:
+        """Атомарно зберігає індекс у файл знімка."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'saved_at': time.time(), 'last_row': last_row, 'codes': len(entries)}) + '\n')
+            f.writelines(f"{code}\t{entry.row}\t{entry.class_name}\t{int(entry.is_used)}\n" for code, entry in entries)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path: str) -> bool:
+        """Завантажує індекс зі знімка. Вік індексу дорівнює віку знімка, тож за наявності зв'язку він оновиться."""
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                meta = json.loads(f.readline())
+                entries: Dict[str, CodeEntry] = {}
+                for line in f:
+                    code, row, class_name, is_used = line.rstrip('\n').split('\t')
+                    entries[code] = CodeEntry(int(row), class_name, is_used == '1')
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Знімок індексу кодів '{path}' пошкоджено: {e}")
+            return False
+        self._entries = entries
+        self._last_row = meta.get('last_row', 1 + len(entries))
+        self._loaded_at = time.monotonic() - max(0.0, time.time() - meta.get('saved_at', 0))
+        logger.info(f"Індекс кодів завантажено зі знімка: {len(entries)} кодів (вік {self.age:.0f} с).")
+        return True
+
+    async def refresh_appended(self) -> bool:
+        """Дочитує лише рядки, додані після останнього читання."""
+        if not self.is_loaded:
+            return await self.refresh()
+        async with self._refresh_lock:
+            start_row = self._last_row + 1
+            # Час спроби фіксується й у разі помилки, щоб CODE_INDEX_MISS_REFRESH обмежував і невдалі читання
+            self._read_at = time.monotonic()
+            rows = await self.manager.read_columns("Codes", self.COLUMNS, start_row=start_row)
+            if rows is None:
+                return False
+            self._entries.update(self._parse(rows, start_row))
+            self._last_row += len(rows)
+            if rows:
+                logger.info(f"Індекс кодів: дочитано {len(rows)} нових рядків.")
+            return True
+
+    async def ensure_fresh(self) -> None:
+        """Оновлює індекс, якщо він ще не завантажений або застарів."""
+        if self.is_stale:
+            await self.refresh()
+
+    def lookup(self, code: str) -> Optional[CodeEntry]:
+        """Повертає запис для коду за O(1) без звернень до API."""
+        return self._entries.get(code)
+
+    def mark_used(self, code: str) -> None:
+        """Позначає код використаним після успішного запису в таблицю."""
+        entry = self._entries.get(code)
+        if entry is not None:
+            self._entries[code] = entry._replace(is_used=True)
+        self._local_marks[code] = time.monotonic()
+
+async def code_index_refresh_task(index: CodeIndex, offline: Optional['OfflineMode'] = None):
+    """Фонова задача: періодично перечитує вкладку 'Codes', щоб підхопити ручні правки."""
+    while True:
+        await asyncio.sleep(CODE_INDEX_REFRESH_INTERVAL)
+        if offline is not None and offline.active:
+            continue  # У резервному режимі індекс оновить відновлення зв'язку
+        try:
+            if not await index.refresh() and offline is not None:
+                offline.enter("не вдалося оновити індекс кодів")
+        except Exception as e:
+            logger.error(f"❌ Помилка фонового оновлення індексу кодів: {e}")
+
+# --- РЕЗЕРВНИЙ РЕЖИМ (GOOGLE SHEETS НЕДОСТУПНА) ---
+class OfflineMode:
+    """Резервний режим на час недоступності Google Sheets."""
+    def __init__(self, manager: SheetsManager, code_index: CodeIndex, path: str = OFFLINE_QUEUE_PATH):
+        self.manager = manager
+        self.code_index = code_index
+        self.path = path
+        self.conflicts_path = f"{os.path.splitext(path)[0]}_conflicts.jsonl"
+        self.active = False
+        self.since: Optional[float] = None
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = asyncio.Lock()
+        # Дозапис у чергу та її перезапис після replay() не перетинаються
+        self._file_lock = asyncio.Lock()
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def load(self) -> None:
+        """Відновлює чергу реєстрацій після перезапуску та позначає ці коди використаними в індексі."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._pending.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # Обірваний останній рядок після аварійної зупинки
+        for registration in self._pending:
+            self.code_index.mark_used(registration['code'])
+        if self._pending:
+            logger.warning(f"Резервний режим: у черзі {len(self._pending)} реєстрацій, ще не записаних у Sheets.")
+
+    def enter(self, reason: str) -> None:
+        if self.active or not self.code_index.is_loaded:
+            return
+        self.active = True
+        self.since = time.monotonic()
+        logger.error(f"🟠 Google Sheets недоступна ({reason}). Переходжу в резервний режим: коди перевіряються за "
+                     f"локальним індексом, реєстрації ставляться в чергу.")
+
+    def _append_sync(self, line: str) -> None:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def queue_registration(self, code: str, row: int, fields: Dict[str, Any]) -> bool:
+        """Надійно записує реєстрацію в локальну чергу. Повертає True, якщо запис на диску."""
+        registration = {'code': code, 'row': row, 'fields': fields, 'queued_at': datetime.now().isoformat()}
+        async with self._file_lock:
+            try:
+                await asyncio.to_thread(self._append_sync, json.dumps(registration, ensure_ascii=False) + '\n')
+            except OSError as e:
+                logger.error(f"❌ Не вдалося записати реєстрацію в чергу '{self.path}': {e}")
+                return False
+            self._pending.append(registration)
+        return True
+
+    def _rewrite_sync(self, registrations: List[Dict[str, Any]]) -> None:
+        """Атомарно замінює файл черги (порожня черга — файл видаляється)."""
+        if not registrations:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(registration, ensure_ascii=False) + '\n' for registration in registrations)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def probe(self) -> bool:
+        """Перевіряє доступність Sheets: підключення (якщо його не було) та читання заголовків 'Codes'."""
+        if not self.manager.is_connected and not await self.manager.connect():
+            return False
+        self.manager.invalidate("Codes")
+        return bool(await self.manager.get_header_map("Codes"))
+
+    async def replay(self) -> Optional[List[Dict[str, Any]]]:
+        """Дозаписує чергу реєстрацій у вкладку 'Codes' і повертає конфлікти (None — якщо не вдалося)."""
+        async with self._lock:
+            # Реєстрації, поставлені в чергу під час дозапису, лишаються в ній до наступного replay()
+            batch = list(self._pending)
+            if not batch:
+                return []
+            rows = await self.manager.read_columns("Codes", ['Unique_Code', 'Is_Used', 'Telegram_ID'])
+            if rows is None:
+                return None
+            sheet = {str(code).strip().upper(): [i + 2, str(is_used).upper() == 'TRUE', str(telegram_id)]
+                     for i, (code, is_used, telegram_id) in enumerate(rows) if code}
+
+            updates: List[Tuple[int, Dict[str, Any]]] = []
+            conflicts: List[Dict[str, Any]] = []
+            for registration in batch:
+                current = sheet.get(registration['code'])
+                telegram_id = str(registration['fields'].get('Telegram_ID'))
+                if current is None:
+                    conflicts.append({**registration, 'reason': "код відсутній у таблиці"})
+                elif current[1] and current[2] != telegram_id:
+                    conflicts.append({**registration, 'reason': f"код уже використав Telegram_ID {current[2]}"})
+                elif not current[1]:
+                    # Номер рядка беремо з таблиці: рядки могли зсунутися за час недоступності
+                    updates.append((current[0], registration['fields']))
+                    current[1], current[2] = True, telegram_id
+
+            results = await asyncio.gather(*[self.manager.update_row_fields("Codes", row, fields) for row, fields in updates])
+            if not all(results):
+                return None
+
+            if conflicts:
+                await asyncio.to_thread(self._write_conflicts_sync, conflicts)
+            async with self._file_lock:
+                remaining = self._pending[len(batch):]
+                await asyncio.to_thread(self._rewrite_sync, remaining)
+                self._pending = remaining
+            logger.warning(f"Резервний режим: дозаписано {len(updates)} реєстрацій, конфліктів: {len(conflicts)}.")
+            return conflicts
+
+    def _write_conflicts_sync(self, conflicts: List[Dict[str, Any]]) -> None:
+        with open(self.conflicts_path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(conflict, ensure_ascii=False) + '\n' for conflict in conflicts)
+
+    async def recover(self) -> Optional[List[Dict[str, Any]]]:
+        """Якщо Sheets знову доступна — дозаписує чергу, оновлює індекс і виходить з резервного режиму."""
+        if not await self.probe():
+            return None
+        conflicts = await self.replay()
+        if conflicts is None:
+            return None
+        await self.code_index.refresh()
+        if self.active:
+            logger.info(f"🟢 Google Sheets знову доступна після {time.monotonic() - self.since:.0f} с. Резервний режим вимкнено.")
+        self.active = False
+        return conflicts
+
+async def offline_mode_task(offline: OfflineMode, bot) -> None:
+    """Фонова задача: у резервному режимі (або з непорожньою чергою) перевіряє зв'язок і дозаписує реєстрації."""
+    while True:
+        await asyncio.sleep(OFFLINE_PROBE_INTERVAL)
+        if not offline.active and not offline.pending_count:
+            continue
+        try:
+            conflicts = await offline.recover()
+        except Exception as e:
+            logger.error(f"❌ Помилка відновлення після резервного режиму: {e}")
+            continue
+        for conflict in conflicts or []:
+            text = (f"⚠️ Конфлікт реєстрації після резервного режиму ('{offline.manager.sheet_name}'): код {conflict['code']} "
+                    f"(Telegram_ID {conflict['fields'].get('Telegram_ID')}) — {conflict['reason']}.")
+            for admin_id in ADMIN_IDS:
+                with contextlib.suppress(TelegramError):
+                    await bot.send_message(admin_id, text)
+
+# --- РЕЗЕРВУВАННЯ КОДІВ ---
+class Reservation(NamedTuple):
+    """Резервування коду: хто його утримує та до якого моменту (monotonic)."""
+    user_id: int
+    expires_at: float
+
+class CodeReservations:
+    """Резервування кодів між receive_code та receive_contact."""
+    # Результати reserve()
+    RESERVED, BUSY, USED = 'reserved', 'busy', 'used'
+
+    def __init__(self, ttl: float = CONVERSATION_TIMEOUT):
+        self.ttl = ttl
+        self._holders: Dict[str, Reservation] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # Кількість корутин, що утримують замок коду або чекають на нього
+        self._lock_users: Dict[str, int] = {}
+        self._last_prune = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._holders)
+
+    async def reserve(self, code: str, user_id: int) -> str:
+        """Резервує код за користувачем. Повертає BUSY, якщо код утримує інший користувач."""
+        now = time.monotonic()
+        if now - self._last_prune > 60:
+            self.prune(now)
+        holder = self._holders.get(code)
+        if holder is not None and holder.user_id != user_id and holder.expires_at > now:
+            return self.BUSY
+        self._holders[code] = Reservation(user_id, now + self.ttl)
+        return self.RESERVED
+
+    async def holds(self, code: str, user_id: int) -> bool:
+        """Перевіряє, що код досі зарезервований саме цим користувачем."""
+        holder = self._holders.get(code)
+        return holder is not None and holder.user_id == user_id and holder.expires_at > time.monotonic()
+
+    async def release(self, code: Optional[str], user_id: int) -> None:
+        """Знімає резервування, якщо його утримує цей користувач."""
+        self._release_local(code, user_id)
+
+    async def commit(self, code: str, user_id: int) -> None:
+        """Код успішно зареєстровано: він позначений використаним в індексі, резервування більше не потрібне."""
+        self._release_local(code, user_id)
+
+    def _release_local(self, code: Optional[str], user_id: int) -> None:
+        holder = self._holders.get(code)
+        if holder is not None and holder.user_id == user_id:
+            del self._holders[code]
+
+    @contextlib.asynccontextmanager
+    async def lock(self, code: str) -> AsyncIterator[None]:
+        """Критична секція реєстрації конкретного коду; замок видаляється, коли його покидає останній учасник."""
+        lock = self._locks.get(code)
+        if lock is None:
+            lock = self._locks[code] = asyncio.Lock()
+        self._lock_users[code] = self._lock_users.get(code, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[code] -= 1
+            if not self._lock_users[code]:
+                del self._locks[code], self._lock_users[code]
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """Видаляє прострочені резервування."""
+        now = now or time.monotonic()
+        for code, holder in list(self._holders.items()):
+            if holder.expires_at <= now:
+                self._release_local(code, holder.user_id)
+        self._last_prune = now
+
+# --- СЕСІЇ РОЗМОВ ГОЛОСУВАННЯ ---
+class VoterSession:
+    """Компактний запис розмови виборця: вибори, код, рядок у 'Codes', клас і стан розмови."""
+    __slots__ = ('election', 'code', 'row', 'class_name', 'state', 'expires_at')
+
+    def __init__(self, code: Optional[str] = None, row: Optional[int] = None, class_name: str = '',
+                 state: Optional[int] = None, expires_at: float = 0.0, election: Optional[str] = None):
+        self.election = election
+        self.code = code
+        self.row = row
+        self.class_name = class_name
+        self.state = state
+        self.expires_at = expires_at
+
+    @property
+    def key(self) -> Optional[str]:
+        """Ключ коду в межах виборів (резервування, ключ ідемпотентності голосу)."""
+        return f"{self.election}:{self.code}" if self.code else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'election': self.election, 'code': self.code, 'row': self.row, 'class': self.class_name, 'state': self.state}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'VoterSession':
+        return cls(data.get('code'), data.get('row'), data.get('class', ''), data.get('state'), election=data.get('election'))
+
+class SessionStore:
+    """Сесії розмов з тайм-аутом на колесі таймерів."""
+    def __init__(self, ttl: float = CONVERSATION_TIMEOUT, tick: float = SESSION_WHEEL_TICK):
+        self.ttl = ttl
+        self.tick = tick
+        self._sessions: Dict[int, VoterSession] = {}
+        self._wheel: List[set] = [set() for _ in range(int(-(-ttl // tick)) + 1)]
+        self._cursor = int(time.monotonic() // tick)
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _slot(self, expires_at: float) -> int:
+        return int(expires_at // self.tick) % len(self._wheel)
+
+    def get(self, user_id: int) -> Optional[VoterSession]:
+        session = self._sessions.get(user_id)
+        if session is not None and session.expires_at <= time.monotonic():
+            del self._sessions[user_id]
+            self.evicted += 1
+            return None
+        return session
+
+    def put(self, user_id: int, session: VoterSession) -> None:
+        """Зберігає сесію та (пере)запускає її тайм-аут."""
+        session.expires_at = time.monotonic() + self.ttl
+        self._sessions[user_id] = session
+        self._wheel[self._slot(session.expires_at)].add(user_id)
+
+    def delete(self, user_id: int) -> None:
+        self._sessions.pop(user_id, None)
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """Обходить комірки, час яких повністю минув, і видаляє прострочені сесії. Повертає їх кількість."""
+        now = time.monotonic() if now is None else now
+        current = int(now // self.tick)
+        # За один виклик достатньо обійти колесо один раз
+        first = max(self._cursor, current - len(self._wheel))
+        evicted = 0
+        for tick in range(first, current):
+            slot = tick % len(self._wheel)
+            bucket = self._wheel[slot]
+            for user_id in list(bucket):
+                session = self._sessions.get(user_id)
+                if session is not None and session.expires_at <= now:
+                    del self._sessions[user_id]
+                    evicted += 1
+                elif session is not None and self._slot(session.expires_at) == slot:
+                    continue  # Сесія закінчиться на наступному оберті колеса
+                bucket.discard(user_id)
+        self._cursor = current
+        self.evicted += evicted
+        return evicted
+
+async def session_eviction_task(store: SessionStore):
+    """Фонова задача: крок колеса таймерів сесій."""
+    while True:
+        await asyncio.sleep(store.tick)
+        evicted = store.advance()
+        if evicted:
+            logger.info(f"Сесії: видалено {evicted} розмов, неактивних понад {store.ttl:.0f} с.")
+
+# --- СПІЛЬНИЙ СТАН ДЛЯ КІЛЬКОХ РЕПЛІК ---
+class KeyValueStore(ABC):
+    """Сховище «ключ-значення» з TTL для стану, спільного між репліками."""
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    async def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        return [await self.get(key) for key in keys]
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    async def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """Атомарно записує значення, лише якщо ключа немає. Повертає True, якщо запис відбувся."""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_if_equals(self, key: str, value: str) -> bool:
+        """Атомарно видаляє ключ, лише якщо його значення дорівнює value."""
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1) -> int:
+        ...
+
+    @abstractmethod
+    async def add_members(self, key: str, members: List[str]) -> None:
+        """Додає рядки до множини key."""
+
+    @abstractmethod
+    async def members(self, key: str) -> set:
+        ...
+
+    @abstractmethod
+    async def count(self, prefix: str) -> int:
+        """Кількість непрострочених ключів, що починаються з prefix."""
+
+    async def close(self) -> None:
+        pass
+
+class MemoryKeyValueStore(KeyValueStore):
+    """Сховище в пам'яті процесу (для тестів та однієї репліки). Атомарність забезпечує цикл подій."""
+    def __init__(self):
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._sets: Dict[str, set] = {}
+
+    def _live(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None: return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._live(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    async def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        if self._live(key) is not None:
+            return False
+        self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def delete_if_equals(self, key: str, value: str) -> bool:
+        if self._live(key) != value:
+            return False
+        del self._data[key]
+        return True
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        value = int(self._live(key) or 0) + amount
+        self._data[key] = (str(value), None)
+        return value
+
+    async def add_members(self, key: str, members: List[str]) -> None:
+        self._sets.setdefault(key, set()).update(members)
+
+    async def members(self, key: str) -> set:
+        return set(self._sets.get(key, ()))
+
+    async def count(self, prefix: str) -> int:
+        return sum(1 for key in list(self._data) if key.startswith(prefix) and self._live(key) is not None)
+
+class SqliteKeyValueStore(KeyValueStore):
+    """Сховище «ключ-значення» у файлі SQLite, спільному для реплік на одному хості."""
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=5, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv_set (key TEXT NOT NULL, member TEXT NOT NULL, PRIMARY KEY (key, member))")
+        # Запити виконуються в потоках (очікування блокування файлу іншою реплікою не зупиняє цикл подій),
+        # а замок не дає транзакціям різних потоків перемежовуватися на одному з'єднанні
+        self._lock = threading.Lock()
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        def locked() -> Any:
+            with self._lock:
+                return fn(*args)
+        return await asyncio.to_thread(locked)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_sync(self, key: str, value: str, ttl: Optional[float]) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                          (key, value, time.time() + ttl if ttl else None))
+
+    def _set_if_absent_sync(self, key: str, value: str, ttl: Optional[float]) -> bool:
+        with self._transaction():
+            if self._get_sync(key) is not None:
+                return False
+            self._set_sync(key, value, ttl)
+            return True
+
+    def _incr_sync(self, key: str, amount: int) -> int:
+        with self._transaction():
+            value = int(self._get_sync(key) or 0) + amount
+            self._set_sync(key, str(value), None)
+            return value
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._run(self._get_sync, key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await self._run(self._set_sync, key, value, ttl)
+
+    async def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return await self._run(self._set_if_absent_sync, key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self._run(self.conn.execute, "DELETE FROM kv WHERE key = ?", (key,))
+
+    async def delete_if_equals(self, key: str, value: str) -> bool:
+        cursor = await self._run(self.conn.execute, "DELETE FROM kv WHERE key = ? AND value = ?", (key, value))
+        return cursor.rowcount == 1
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self._run(self._incr_sync, key, amount)
+
+    async def add_members(self, key: str, members: List[str]) -> None:
+        await self._run(self.conn.executemany, "INSERT OR IGNORE INTO kv_set (key, member) VALUES (?, ?)",
+                        [(key, member) for member in members])
+
+    def _members_sync(self, key: str) -> set:
+        return {row[0] for row in self.conn.execute("SELECT member FROM kv_set WHERE key = ?", (key,))}
+
+    async def members(self, key: str) -> set:
+        return await self._run(self._members_sync, key)
+
+    def _count_sync(self, prefix: str) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM kv WHERE substr(key, 1, ?) = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (len(prefix), prefix, time.time())
+        ).fetchone()[0]
+
+    async def count(self, prefix: str) -> int:
+        return await self._run(self._count_sync, prefix)
+
+    async def close(self) -> None:
+        await self._run(self.conn.close)
+
+class RedisKeyValueStore(KeyValueStore):
+    """Сховище в Redis (або сумісному сервері) — для реплік на різних хостах."""
+    _DELETE_IF_EQUALS = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("Для SHARED_STATE_URL=redis://... встановіть пакет redis: pip install redis")
+        self.client = aioredis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.client.get(key)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        return await self.client.mget(keys) if keys else []
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await self.client.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return bool(await self.client.set(key, value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+
+    async def delete_if_equals(self, key: str, value: str) -> bool:
+        return bool(await self.client.eval(self._DELETE_IF_EQUALS, 1, key, value))
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self.client.incrby(key, amount)
+
+    async def add_members(self, key: str, members: List[str]) -> None:
+        if members:
+            await self.client.sadd(key, *members)
+
+    async def members(self, key: str) -> set:
+        return set(await self.client.smembers(key))
+
+    async def count(self, prefix: str) -> int:
+        # SCAN не блокує сервер, на відміну від KEYS; викликається лише при запиті /metrics
+        return sum([1 async for _ in self.client.scan_iter(match=f"{prefix}*", count=1000)])
+
+    async def close(self) -> None:
+        await self.client.close()
+
+def open_key_value_store(url: str) -> KeyValueStore:
+    """Створює сховище за SHARED_STATE_URL: memory://, sqlite:///шлях або redis://..."""
+    if url.startswith('memory://'):
+        return MemoryKeyValueStore()
+    if url.startswith('sqlite:///'):
+        return SqliteKeyValueStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisKeyValueStore(url)
+    raise ValueError(f"Невідомий SHARED_STATE_URL: '{url}'")
+
+class SharedCodeReservations(CodeReservations):
+    """Резервування кодів у спільному сховищі."""
+    def __init__(self, kv: KeyValueStore, ttl: float = CONVERSATION_TIMEOUT):
+        super().__init__(ttl)
+        self.kv = kv
+
+    async def reserve(self, code: str, user_id: int) -> str:
+        if await self.kv.get(f"used:{code}") is not None:
+            return self.USED
+        key = f"reservation:{code}"
+        if await self.kv.set_if_absent(key, str(user_id), self.ttl):
+            return self.RESERVED
+        if await self.kv.get(key) == str(user_id):
+            # Той самий користувач ввів код повторно — подовжуємо резервування
+            await self.kv.set(key, str(user_id), self.ttl)
+            return self.RESERVED
+        return self.BUSY
+
+    async def holds(self, code: str, user_id: int) -> bool:
+        return await self.kv.get(f"reservation:{code}") == str(user_id)
+
+    async def release(self, code: Optional[str], user_id: int) -> None:
+        if code:
+            await self.kv.delete_if_equals(f"reservation:{code}", str(user_id))
+
+    async def commit(self, code: str, user_id: int) -> None:
+        await self.kv.set(f"used:{code}", str(user_id))
+        await self.release(code, user_id)
+
+class UserLockTimeout(Exception):
+    """Блокування користувача утримує інша репліка довше за USER_LOCK_WAIT."""
+
+class SharedState:
+    """Сесії, блокування, ключі голосів і лічильники, спільні для реплік."""
+    def __init__(self, kv: KeyValueStore, ttl: float = CONVERSATION_TIMEOUT):
+        self.kv = kv
+        self.ttl = ttl
+
+    async def load_session(self, user_id: int) -> Optional[VoterSession]:
+        raw = await self.kv.get(f"session:{user_id}")
+        return VoterSession.from_dict(json.loads(raw)) if raw else None
+
+    async def active_sessions(self) -> int:
+        return await self.kv.count("session:")
+
+    async def save_session(self, user_id: int, session: VoterSession) -> None:
+        await self.kv.set(f"session:{user_id}", json.dumps(session.to_dict(), ensure_ascii=False), self.ttl)
+
+    async def delete_session(self, user_id: int) -> None:
+        await self.kv.delete(f"session:{user_id}")
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id: int) -> AsyncIterator[None]:
+        """Блокування користувача між репліками (з TTL на випадок падіння репліки)."""
+        key, token = f"lock:user:{user_id}", uuid.uuid4().hex
+        deadline = time.monotonic() + USER_LOCK_WAIT
+        acquired = await self.kv.set_if_absent(key, token, USER_LOCK_TTL)
+        while not acquired and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+            acquired = await self.kv.set_if_absent(key, token, USER_LOCK_TTL)
+        if not acquired:
+            # Обробка без блокування порушила б порядок оновлень користувача між репліками
+            raise UserLockTimeout(f"Блокування користувача {user_id} зайняте довше за {USER_LOCK_WAIT} с.")
+        try:
+            yield
+        finally:
+            await self.kv.delete_if_equals(key, token)
+
+    async def claim_vote(self, key: str) -> bool:
+        """Ключ ідемпотентності голосу: True лише для першої спроби проголосувати з цим кодом (VoterSession.key)."""
+        return await self.kv.set_if_absent(f"vote:{key}", '1')
+
+    async def release_vote(self, key: str) -> None:
+        await self.kv.delete(f"vote:{key}")
+
+    async def record_vote(self, election: 'Election', class_name: str, candidate: str) -> None:
+        # Спершу пара потрапляє в множину відомих лічильників, інакше load_tally міг би її пропустити
+        await self.kv.add_members(f"tally:{election.id}:keys", [self._pair(None, candidate), self._pair(class_name, candidate)])
+        await asyncio.gather(
+            self.kv.incr(self._tally_key(election, None, candidate)),
+            self.kv.incr(self._tally_key(election, class_name, candidate)),
+        )
+
+    @staticmethod
+    def _pair(class_name: Optional[str], candidate: str) -> str:
+        return json.dumps([class_name, candidate], ensure_ascii=False)
+
+    async def _tally_pairs(self, election: 'Election') -> List[Tuple[Optional[str], str]]:
+        """Усі пари (клас або None для загального лічильника, кандидат), за якими є спільні лічильники."""
+        return [tuple(json.loads(member)) for member in await self.kv.members(f"tally:{election.id}:keys")]
+
+    @staticmethod
+    def _tally_key(election: 'Election', class_name: Optional[str], candidate: str) -> str:
+        if class_name is None:
+            return f"tally:{election.id}:candidate:{candidate}"
+        return f"tally:{election.id}:class:{class_name}:{candidate}"
+
+    async def load_tally(self, election: 'Election') -> None:
+        """Заповнює підрахунок виборів лічильниками зі спільного сховища (голоси всіх реплік)."""
+        tally = election.tally
+        keys = await self._tally_pairs(election)
+        values = await self.kv.get_many([self._tally_key(election, *key) for key in keys])
+        tally.total = 0
+        tally.by_candidate = {}
+        tally.by_class = {}
+        for (class_name, candidate), value in zip(keys, values):
+            count = int(value or 0)
+            if not count:
+                continue
+            if class_name is None:
+                tally.total += count
+                tally.by_candidate[candidate] = count
+            else:
+                tally.by_class.setdefault(class_name, {})[candidate] = count
+        tally.is_seeded = True
+
+    async def publish_tally(self, election: 'Election') -> None:
+        """Перезаписує спільні лічильники виборів значеннями звіреного з таблицею підрахунку."""
+        tally = election.tally
+        pairs = {(None, candidate) for candidate in tally.by_candidate}
+        pairs |= {(class_name, candidate) for class_name, counts in tally.by_class.items() for candidate in counts}
+        await self.kv.add_members(f"tally:{election.id}:keys", [self._pair(*pair) for pair in pairs])
+        # Лічильники, яких немає в звіреному підрахунку, обнуляються
+        for class_name, candidate in set(await self._tally_pairs(election)) | pairs:
+            if class_name is None:
+                count = tally.by_candidate.get(candidate, 0)
+            else:
+                count = tally.by_class.get(class_name, {}).get(candidate, 0)
+            await self.kv.set(self._tally_key(election, class_name, candidate), str(count))
+        await self.kv.set(f"tally:{election.id}:seeded", '1')
+
+    async def seed_tally(self, election: 'Election') -> None:
+        """Перша репліка, що запустилася, заповнює спільні лічильники з таблиці; решта їх лише читають."""
+        if await self.kv.get(f"tally:{election.id}:seeded") is None and election.tally.is_seeded:
+            await self.publish_tally(election)
+
+def voter_session(expected_state: Optional[int]) -> Callable:
+    """Декоратор кроку розмови: виконує крок лише в стані expected_state сесії, потім зберігає або видаляє сесію."""
+    def decorator(callback: Callable) -> Callable:
+        async def run_step(update: Update, context: ContextTypes.DEFAULT_TYPE, shared: Optional['SharedState']):
+            user_id = update.effective_user.id
+            sessions: SessionStore = context.bot_data['sessions']
+            session = await shared.load_session(user_id) if shared else sessions.get(user_id)
+            current = session.state if session else None
+            if expected_state is not None and current != expected_state:
+                # Сесія — єдиний стан розмови: оновлення не для поточного кроку ігнорується.
+                # Текст і контакти поза розмовою — мовчки: відповідь на кожне коштувала б виклик Bot API
+                if update.callback_query:
+                    if current is None:
+                        await update.callback_query.answer(
+                            "⌛ Сесію не розпочато або її час минув. Почніть спочатку командою /start.", show_alert=True)
+                    else:
+                        await update.callback_query.answer()
+                return current
+
+            context.session = session or VoterSession()
+            state = await callback(update, context)
+            if state == ConversationHandler.END:
+                if shared: await shared.delete_session(user_id)
+                else: sessions.delete(user_id)
+            elif state is not None:
+                context.session.state = state
+                if shared: await shared.save_session(user_id, context.session)
+                else: sessions.put(user_id, context.session)
+            return state
+
+        @wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if update.effective_user is None:
+                return await callback(update, context)
+
+            shared: Optional[SharedState] = context.bot_data.get('shared_state')
+            if shared is None:
+                return await run_step(update, context, None)
+            try:
+                async with shared.user_lock(update.effective_user.id):
+                    return await run_step(update, context, shared)
+            except UserLockTimeout as e:
+                # Оновлення не обробляється без блокування: користувач повторить дію
+                logger.warning(f"⚠️ {e} Оновлення {update.update_id} не оброблено.")
+                text = "⏳ Попередню дію ще обробляємо. Спробуйте ще раз за кілька секунд."
+                if update.callback_query:
+                    await update.callback_query.answer(text, show_alert=True)
+                else:
+                    await update.effective_message.reply_text(text)
+                return None
+        return wrapper
+    return decorator
+
+# --- ЖУРНАЛ ГОЛОСІВ (WRITE-BEHIND) ---
+class JournalEntry(NamedTuple):
+    """Запис журналу голосів: порядковий номер та рядок для вкладки 'Votes'."""
+    seq: int
+    row: List[Any]
+
+class VoteJournal:
+    """Локальний журнал голосів, що пакетно переноситься у вкладку 'Votes'."""
+    def __init__(self, manager: StorageBackend, path: str = VOTE_JOURNAL_PATH):
+        self.manager = manager
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self._pending: List[JournalEntry] = []
+        self._last_seq = 0
+        self._flushed_seq = 0
+        self._inflight: Optional[Tuple[int, int]] = None
+        self._file = None
+        self._append_lock = asyncio.Lock()
+        self.flush_lock = asyncio.Lock()
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def pending_rows(self) -> List[List[Any]]:
+        """Рядки голосів, які ще не перенесені у вкладку 'Votes'."""
+        return [entry.row for entry in self._pending]
+
+    def load(self) -> None:
+        """Відновлює стан з диска: контрольну точку та неперенесені записи журналу."""
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            self._flushed_seq = checkpoint.get('flushed_seq', 0)
+            inflight = checkpoint.get('inflight')
+            self._inflight = tuple(inflight) if inflight else None
+        self._last_seq = self._flushed_seq
+
+        valid_bytes = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for raw_line in f:
+                    if not raw_line.endswith(b'\n'):
+                        break  # Недописаний рядок після аварійного завершення
+                    try:
+                        record = json.loads(raw_line)
+                    except ValueError:
+                        break
+                    valid_bytes += len(raw_line)
+                    self._last_seq = max(self._last_seq, record['seq'])
+                    if record['seq'] > self._flushed_seq:
+                        self._pending.append(JournalEntry(record['seq'], record['row']))
+            # Обрізаємо пошкоджений хвіст, щоб нові записи не «приклеїлись» до нього
+            if valid_bytes != os.path.getsize(self.path):
+                logger.warning(f"⚠️ Журнал голосів: обрізаю пошкоджений хвіст файлу '{self.path}'.")
+                with open(self.path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._pending:
+            logger.warning(f"Журнал голосів: знайдено {len(self._pending)} неперенесених голосів, їх буде дозаписано.")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_line_sync(self, line: str) -> None:
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _write_checkpoint_sync(self) -> None:
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'flushed_seq': self._flushed_seq, 'inflight': self._inflight}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    async def append(self, row: List[Any]) -> bool:
+        """Надійно (з fsync) записує голос у журнал. Після повернення True голос не буде втрачено."""
+        async with self._append_lock:
+            seq = self._last_seq + 1
+            line = json.dumps({'seq': seq, 'row': row}, ensure_ascii=False) + '\n'
+            try:
+                await asyncio.to_thread(self._write_line_sync, line)
+            except OSError as e:
+                logger.error(f"❌ Помилка запису голосу в журнал '{self.path}': {e}")
+                return False
+            self._last_seq = seq
+            self._pending.append(JournalEntry(seq, row))
+            return True
+
+    async def _resolve_inflight(self) -> bool:
+        """Звіряє пакет, відправка якого не була підтверджена, з вкладкою 'Votes'."""
+        start_seq, end_seq = self._inflight
+        votes_keys = await self.manager.read_columns("Votes", ['Timestamp', 'Unique_Code'])
+        if votes_keys is None:
+            return False
+        # Голос однозначно ідентифікується часом (ISO з мікросекундами) та кодом
+        sheet_keys = {(row[0], row[1]) for row in votes_keys}
+        applied = {
+            entry.seq for entry in self._pending
+            if start_seq <= entry.seq <= end_seq and (str(entry.row[0]), str(entry.row[2])) in sheet_keys
+        }
+        if applied:
+            logger.warning(f"Журнал голосів: {len(applied)} голосів з непідтвердженого пакета вже є в таблиці, пропускаю їх.")
+            self._pending = [entry for entry in self._pending if entry.seq not in applied]
+        self._inflight = None
+        self._flushed_seq = self._pending[0].seq - 1 if self._pending else self._last_seq
+        await asyncio.to_thread(self._write_checkpoint_sync)
+        return True
+
+    async def flush(self) -> int:
+        """Переносить неперенесені голоси у вкладку 'Votes'. Повертає кількість перенесених голосів."""
+        async with self.flush_lock:
+            if self._inflight is not None and not await self._resolve_inflight():
+                return 0
+
+            flushed = 0
+            while self._pending:
+                batch = self._pending[:VOTE_FLUSH_BATCH]
+                self._inflight = (batch[0].seq, batch[-1].seq)
+                await asyncio.to_thread(self._write_checkpoint_sync)
+
+                if not await self.manager.append_rows("Votes", [entry.row for entry in batch]):
+                    # Результат невідомий: пакет буде звірено з таблицею перед наступною спробою
+                    break
+
+                del self._pending[:len(batch)]
+                self._flushed_seq = batch[-1].seq
+                self._inflight = None
+                await asyncio.to_thread(self._write_checkpoint_sync)
+                flushed += len(batch)
+
+            # Блокуємо нові записи, щоб обрізання не зачепило щойно доданий голос
+            async with self._append_lock:
+                if not self._pending and self._inflight is None:
+                    await asyncio.to_thread(self._compact_sync)
+            return flushed
+
+    def _compact_sync(self) -> None:
+        """Обрізає повністю перенесений журнал, щоб файл не ріс безмежно."""
+        if self._file is None or self._file.tell() < VOTE_JOURNAL_COMPACT_BYTES:
+            return
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+async def vote_journal_flush_task(journal: VoteJournal):
+    """Фонова задача: періодично переносить голоси з журналу у вкладку 'Votes'."""
+    while True:
+        await asyncio.sleep(VOTE_FLUSH_INTERVAL)
+        try:
+            flushed = await journal.flush()
+            if flushed:
+                logger.info(f"Журнал голосів: перенесено {flushed} голосів у вкладку 'Votes'.")
+        except Exception as e:
+            logger.error(f"❌ Помилка перенесення журналу голосів: {e}")
+
+# --- ПІДРАХУНОК ГОЛОСІВ У ПАМ'ЯТІ ---
+class VoteTally:
+    """Підрахунок голосів у пам'яті для /result."""
+    def __init__(self, manager: StorageBackend, journal: VoteJournal):
+        self.manager = manager
+        self.journal = journal
+        self.total = 0
+        self.by_candidate: Dict[str, int] = {}
+        self.by_class: Dict[str, Dict[str, int]] = {}
+        self.is_seeded = False
+
+    def record(self, class_name: str, candidate: str) -> None:
+        """Враховує один голос."""
+        self.total += 1
+        self.by_candidate[candidate] = self.by_candidate.get(candidate, 0) + 1
+        class_counts = self.by_class.setdefault(class_name, {})
+        class_counts[candidate] = class_counts.get(candidate, 0) + 1
+
+    async def reconcile(self) -> bool:
+        """Повністю перераховує голоси з вкладки 'Votes' та журналу. Повертає True у разі успіху."""
+        # Поки читаємо таблицю, журнал не переносить голоси, інакше частину з них порахуємо двічі
+        async with self.journal.flush_lock:
+            # Для підрахунку потрібні лише дві колонки з семи
+            votes_rows = await self.manager.read_columns("Votes", ['Class', 'Candidate_Voted'])
+            if votes_rows is None:
+                return False
+            pending_rows = self.journal.pending_rows()
+
+        self.total = 0
+        self.by_candidate = {}
+        self.by_class = {}
+        for class_name, candidate in votes_rows:
+            self.record(str(class_name or 'N/A'), candidate or UNKNOWN_CANDIDATE)
+        # [Timestamp, Class, Unique_Code, Telegram_ID, Username, Full_Name, Candidate_Voted]
+        for row in pending_rows:
+            self.record(str(row[1]), row[6])
+
+        self.is_seeded = True
+        logger.info(f"Підрахунок голосів звірено з таблицею: {self.total} голосів.")
+        return True
+
+# --- ОДНОРАЗОВА ФУНКЦІЯ ГЕНЕРАЦІЇ КОДІВ ---
+def generate_codes(config: Dict[str, int], existing: set, alphabet: str = CODE_ALPHABET, length: int = CODE_LENGTH) -> List[List[Any]]:
+    """Генерує рядки для вкладки 'Codes' з унікальними випадковими кодами."""
+    total = sum(config.values())
+    if total + len(existing) > len(alphabet) ** length // 2:
+        raise ValueError(f"Простір кодів ({len(alphabet)}^{length}) замалий для {total} нових кодів.")
+
+    rng = random.SystemRandom()
+    issued = set(existing)
+    rows = []
+    for class_name, count in config.items():
+        for _ in range(count):
+            unique_code = ''.join(rng.choices(alphabet, k=length))
+            while unique_code in issued:
+                unique_code = ''.join(rng.choices(alphabet, k=length))
+            issued.add(unique_code)
+            # [Class, Student_Count, Unique_Code, Is_Used, Telegram_ID, Phone_Number, Full_Name]
+            rows.append([class_name, count, unique_code, 'FALSE', '', '', ''])
+    return rows
+
+async def generate_unique_codes_to_sheets(manager: SheetsManager, config: Dict[str, int], reset: bool = True,
+                                          checkpoint_path: str = CODE_GENERATION_CHECKPOINT) -> bool:
+    """
+    Генерує унікальні коди на основі конфігурації класів виборів (config) і записує їх у вкладку 'Codes' частинами
+    по CODE_UPLOAD_CHUNK рядків.
+
+    Спочатку весь план (рядки з кодами) зберігається у файл checkpoint_path. Якщо запуск перервано,
+    наступний виклик дозавантажує план з того самого файлу (без очищення вкладки), пропускаючи коди,
+    які вже є в таблиці.
+    УВАГА: якщо reset=True і незавершеного плану немає, функція очищає всі існуючі записи в 'Codes'.
+    """
+    codes_ws = await manager.get_worksheet("Codes")
+    if codes_ws is None: 
+        logger.error("Генерація кодів: Не вдалося отримати вкладку 'Codes'.")
+        return False
+
+    resuming = os.path.exists(checkpoint_path)
+    if not resuming and reset:
+        # Очистка старої таблиці (крім заголовків)
+        try:
+            logger.info("Генерація кодів: Очищую існуючі записи...")
+            # Використовуємо методи gspread через клієнт API (квота та повтори)
+            await manager.api.call(codes_ws.resize, rows=1, cols=7) # Зменшуємо до 1 рядка
+            await manager.api.call(codes_ws.resize, rows=1000) # Повертаємо багато рядків для майбутніх записів
+        except Exception as e:
+            logger.error(f"Генерація кодів: Не вдалося очистити стару таблицю Codes: {e}")
+            # Не зупиняємося, якщо очистка не вдалася, спробуємо оновити заголовки
+            pass
+
+        # Заголовки (на випадок, якщо вони були видалені)
+        await manager.api.call(codes_ws.update, 'A1:G1', [CODES_HEADER])
+        manager.invalidate("Codes")
+
+    # Коди, що вже є в таблиці: з ними не можна перетинатися, а при відновленні їх не треба дозавантажувати
+    existing_rows = await manager.read_columns("Codes", ['Unique_Code'])
+    if existing_rows is None:
+        logger.error("Генерація кодів: Не вдалося прочитати вкладку 'Codes'.")
+        return False
+    existing = {row[0].strip().upper() for row in existing_rows if row[0]}
+
+    if resuming:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            plan = [json.loads(line) for line in f if line.strip()]
+        logger.warning(f"Генерація кодів: знайдено незавершений план ({len(plan)} кодів), продовжую завантаження.")
+    else:
+        plan = generate_codes(config, existing)
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in plan:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, checkpoint_path)
+
+    remaining = [row for row in plan if row[2] not in existing]
+    uploaded = len(plan) - len(remaining)
+    for start_index in range(0, len(remaining), CODE_UPLOAD_CHUNK):
+        chunk = remaining[start_index:start_index + CODE_UPLOAD_CHUNK]
+        if not await manager.append_rows("Codes", chunk):
+            logger.error(f"❌ Генерація кодів: завантаження перервано на {uploaded}/{len(plan)}. Наступний запуск продовжить з цього місця.")
+            return False
+        uploaded += len(chunk)
+        logger.info(f"Генерація кодів: завантажено {uploaded}/{len(plan)} кодів.")
+
+    os.remove(checkpoint_path)
+    logger.info(f"✅ Генерація кодів: Успішно згенеровано та записано {len(plan)} унікальних кодів.")
+    return True
+
+# --- РОЗСИЛКА ПОВІДОМЛЕНЬ ВИБОРЦЯМ ---
+# Аудиторії розсилки: усі зареєстровані, ті, хто ще не проголосував, та ті, хто вже проголосував
+BROADCAST_AUDIENCES = {
+    'registered': "усім зареєстрованим",
+    'unvoted': "зареєстрованим, які ще не проголосували",
+    'voted': "тим, хто вже проголосував",
+}
+
+def _telegram_ids(values: Iterable[Any]) -> set:
+    """Перетворює значення колонки Telegram_ID на множину числових ID (порожні та некоректні пропускаються)."""
+    ids = set()
+    for value in values:
+        value = str(value).strip()
+        if value.lstrip('-').isdigit():
+            ids.add(int(value))
+    return ids
+
+async def _election_voters(election: 'Election') -> Optional[Tuple[set, set]]:
+    """Повертає (зареєстровані, проголосували) Telegram_ID одних виборів або None."""
+    codes_rows, votes_rows = await asyncio.gather(
+        election.storage.read_columns("Codes", ['Telegram_ID', 'Is_Used']),
+        election.storage.read_columns("Votes", ['Telegram_ID']),
+    )
+    if codes_rows is None or votes_rows is None:
+        return None
+
+    registered = _telegram_ids(telegram_id for telegram_id, is_used in codes_rows if str(is_used).upper() == 'TRUE')
+    # [Timestamp, Class, Unique_Code, Telegram_ID, Username, Full_Name, Candidate_Voted]
+    voted = _telegram_ids(row[0] for row in votes_rows) | _telegram_ids(row[3] for row in election.journal.pending_rows())
+    return registered, voted
+
+async def collect_broadcast_recipients(elections: Iterable['Election'], audience: str) -> Optional[List[int]]:
+    """Формує список отримувачів розсилки з усіх виборів або None."""
+    voters = await asyncio.gather(*[_election_voters(election) for election in elections])
+    if any(item is None for item in voters):
+        return None
+
+    recipients = set()
+    for registered, voted in voters:
+        if audience == 'unvoted':
+            recipients |= registered - voted
+        elif audience == 'voted':
+            recipients |= voted
+        else:
+            recipients |= registered | voted
+    return sorted(recipients)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза з RetryAfter у секундах (залежно від налаштувань PTB retry_after — int або timedelta)."""
+    return error.retry_after.total_seconds() if isinstance(error.retry_after, timedelta) else float(error.retry_after)
+
+class Broadcaster:
+    """Розсилка повідомлень з лімітом Telegram і можливістю продовжити після перезапуску."""
+    SENT, BLOCKED, FAILED = 'sent', 'blocked', 'failed'
+
+    def __init__(self, bot, path: str = BROADCAST_STATE_PATH, rate: float = BROADCAST_RATE,
+                 workers: int = BROADCAST_WORKERS, max_retries: int = BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.path = path
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.workers = workers
+        self.max_retries = max_retries
+        self.header: Optional[Dict[str, Any]] = None
+        self.results: Dict[int, str] = {}
+        self.started_at = 0.0
+        self._paused_until = 0.0
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self) -> List[int]:
+        if not self.header:
+            return []
+        return [chat_id for chat_id in self.header['recipients'] if chat_id not in self.results]
+
+    def counts(self) -> Dict[str, int]:
+        counts = {self.SENT: 0, self.BLOCKED: 0, self.FAILED: 0}
+        for status in self.results.values():
+            counts[status] += 1
+        return counts
+
+    def load(self) -> bool:
+        """Завантажує незавершену розсилку з файлу прогресу. Повертає True, якщо є що продовжувати."""
+        if not os.path.exists(self.path):
+            return False
+        header, results, finished = None, {}, False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Обірваний останній рядок після аварійної зупинки
+                if 'recipients' in record:
+                    header = record
+                elif record.get('finished'):
+                    finished = True
+                elif 'chat_id' in record:
+                    results[record['chat_id']] = record['status']
+        if header is None or finished:
+            return False
+        self.header, self.results = header, results
+        return bool(self.pending)
+
+    def start(self, text: str, recipients: List[int], audience: str, admin_chat_id: int) -> None:
+        """Починає нову розсилку (попередній файл прогресу перезаписується)."""
+        self.header = {
+            'id': uuid.uuid4().hex, 'text': text, 'audience': audience,
+            'admin_chat_id': admin_chat_id, 'recipients': recipients,
+        }
+        self.results = {}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header, ensure_ascii=False) + '\n')
+        self._task = asyncio.create_task(self._run())
+
+    def resume(self) -> None:
+        """Продовжує завантажену розсилку з того місця, де її було перервано."""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.is_running:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    def _record(self, chat_id: int, status: str) -> None:
+        self.results[chat_id] = status
+        self._file.write(json.dumps({'chat_id': chat_id, 'status': status}) + '\n')
+        self._file.flush()
+
+    async def _run(self) -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in self.pending:
+            queue.put_nowait(chat_id)
+        self.started_at = time.monotonic()
+        logger.info(f"📣 Розсилка {self.header['id'][:8]}: {queue.qsize()} отримувачів у черзі.")
+
+        self._file = open(self.path, 'a', encoding='utf-8')
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(min(self.workers, queue.qsize()) or 1)]
+        try:
+            await queue.join()
+            self._file.write(json.dumps({'finished': True}) + '\n')
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._file.close()
+            self._file = None
+
+        counts = self.counts()
+        elapsed = time.monotonic() - self.started_at
+        summary = (f"📣 Розсилку завершено за {elapsed:.0f} с: надіслано {counts[self.SENT]}, "
+                   f"заблокували бота {counts[self.BLOCKED]}, помилок {counts[self.FAILED]}.")
+        logger.info(summary)
+        with contextlib.suppress(Exception):
+            await self.bot.send_message(self.header['admin_chat_id'], summary)
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            chat_id = await queue.get()
+            try:
+                self._record(chat_id, await self._send(chat_id))
+            except Exception as e:
+                logger.error(f"Помилка розсилки в чат {chat_id}: {e}")
+                self._record(chat_id, self.FAILED)
+            finally:
+                queue.task_done()
+
+    async def _send(self, chat_id: int) -> str:
+        for attempt in range(self.max_retries + 1):
+            # RetryAfter від Telegram зупиняє всіх воркерів, а не лише той, що його отримав
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, self.header['text'])
+                return self.SENT
+            except RetryAfter as e:
+                retry_after = retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(f"⚠️ Розсилка: ліміт Telegram, пауза {retry_after:.0f} с.")
+            except Forbidden:
+                return self.BLOCKED  # Користувач заблокував бота — повтор не допоможе
+            except BadRequest as e:
+                logger.warning(f"⚠️ Розсилка: чат {chat_id} недоступний: {e}")
+                return self.FAILED
+            except NetworkError as e:
+                logger.warning(f"⚠️ Розсилка: мережева помилка для чату {chat_id} (спроба {attempt + 1}): {e}")
+                await asyncio.sleep(max(BROADCAST_CHAT_INTERVAL, 2 ** attempt))
+        return self.FAILED
+
+# --- РЕЗУЛЬТАТИ ТА ЖИВА ПАНЕЛЬ ДЛЯ АДМІНІСТРАТОРІВ ---
+def format_results(election: 'Election') -> str:
+    """Текст результатів виборів (Markdown): голоси за кандидатами та явка за класами відносно їх class_config."""
+    tally = election.tally
+    class_config = election.class_config
+    total_votes = tally.total
+
+    results_text = f"📊 **Результати: {election.title}**\n\n"
+    results_text += f"Всього зарахованих голосів: **{total_votes}**\n\n"
+
+    sorted_results = sorted(tally.by_candidate.items(), key=lambda item: item[1], reverse=True)
+
+    for candidate, count in sorted_results:
+        percentage = (count / total_votes) * 100 if total_votes > 0 else 0
+
+        # Створюємо простий графік за допомогою емодзі
+        blocks = int(percentage / 10)
+        chart = '█' * blocks + '░' * (10 - blocks)
+
+        results_text += (
+            f"**{candidate}**:\n"
+            f"   {count} голосів ({percentage:.2f}%)\n"
+            f"   `{chart}`\n"
+        )
+
+    # Явка за класами: кількість голосів відносно кількості учнів з class_config
+    students_total = sum(class_config.values())
+    turnout_total = (total_votes / students_total) * 100 if students_total else 0
+    results_text += f"\n🏫 **Явка за класами** (загалом {total_votes}/{students_total}, {turnout_total:.1f}%):\n"
+    for class_name in sorted(set(class_config) | set(tally.by_class)):
+        voted = sum(tally.by_class.get(class_name, {}).values())
+        students = class_config.get(class_name)
+        if students:
+            results_text += f"{class_name}: {voted}/{students} ({voted / students * 100:.1f}%)\n"
+        else:
+            results_text += f"{class_name}: {voted}\n"
+    return results_text
+
+class LiveResults:
+    """Закріплене повідомлення з результатами виборів, що оновлюється після нових голосів."""
+    def __init__(self, bot, election: 'Election', path: str = LIVE_RESULTS_PATH, interval: float = LIVE_RESULTS_INTERVAL):
+        self.bot = bot
+        self.election = election
+        self.path = path
+        self.interval = interval
+        self.shared: Optional[SharedState] = None
+        # chat_id адміністратора -> message_id закріпленого повідомлення
+        self.subscribers: Dict[int, int] = {}
+        self._dirty = False
+        self._last_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
 
-# Кандидати для голосування
-CANDIDATES = {
-    "Viktoriia Kochut": "Вікторія Кочут",
-    "Oleksandr Bilostotskyi": "Білостоцький Олександр",
-    "Yeva Baziuta": "Єва Базюта",
-    "Anna Strilchuk": "Анна Стрільчук"
-}
+    def load(self) -> None:
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.subscribers = {int(chat_id): message_id for chat_id, message_id in json.load(f).items()}
 
-# Стани для ConversationHandler
-(WAITING_FOR_CODE, WAITING_FOR_CONTACT, WAITING_FOR_VOTE) = range(3)
+    def _save(self) -> None:
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.subscribers, f)
 
-# --- ЛОГУВАННЯ ---
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-logger = logging.getLogger(__name__)
+    async def render(self) -> str:
+        if self.shared:
+            # Кілька реплік: голоси всіх реплік є лише у спільних лічильниках
+            await self.shared.load_tally(self.election)
+        return f"{format_results(self.election)}\n🔴 Наживо, оновлено о {datetime.now().strftime('%H:%M:%S')}"
 
-# --- МЕНЕДЖЕР GOOGLE SHEETS (GSPREAD) ---
-class SheetsManager:
-    """Клас для безпечної взаємодії з Google Sheets через gspread."""
-    def __init__(self, json_creds_str: str, sheet_name: str):
-        self.sheet_name = sheet_name
-        self.is_connected = False
-        self.client = None
-        self.sheet = None
+    async def subscribe(self, chat_id: int) -> None:
+        """Надсилає та закріплює повідомлення з результатами і починає його оновлювати."""
+        message = await self.bot.send_message(chat_id, await self.render(), parse_mode='Markdown')
+        with contextlib.suppress(TelegramError):
+            await self.bot.pin_chat_message(chat_id, message.message_id, disable_notification=True)
+        previous = self.subscribers.get(chat_id)
+        self.subscribers[chat_id] = message.message_id
+        self._save()
+        if previous:
+            with contextlib.suppress(TelegramError):
+                await self.bot.unpin_chat_message(chat_id, previous)
+
+    async def unsubscribe(self, chat_id: int) -> bool:
+        message_id = self.subscribers.pop(chat_id, None)
+        if message_id is None:
+            return False
+        self._save()
+        with contextlib.suppress(TelegramError):
+            await self.bot.unpin_chat_message(chat_id, message_id)
+        return True
+
+    def notify(self) -> None:
+        """Викликається після кожного голосу: планує оновлення панелей (з дебаунсом)."""
+        if not self.subscribers:
+            return
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._publish())
 
-        if json_creds_str and sheet_name:
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _publish(self) -> None:
+        # Голоси, що надійшли під час очікування чи редагування, потрапляють у наступне оновлення
+        while self._dirty:
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._dirty = False
             try:
-                # 1. Розпарсити JSON-рядок на Python словник
-                creds_dict = json.loads(json_creds_str)
-                # 2. Використовувати словник для авторизації
-                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-                self.client = gspread.authorize(creds)
-                
-                # 3. Відкрити таблицю
-                self.sheet = self.client.open(sheet_name)
-                self.is_connected = True
-                logger.info("✅ Успішне підключення до Google Sheets.")
+                text = await self.render()
+                await asyncio.gather(*[self._edit(chat_id, message_id, text) for chat_id, message_id in list(self.subscribers.items())])
             except Exception as e:
-                # Змінюємо логування для більшої інформативності
-                logger.error(f"❌ Критична помилка підключення до Google Sheets. Перевірте GSPREAD_SECRET_JSON, права доступу та назву таблиці '{sheet_name}'. Деталі: {e}")
-                self.is_connected = False
+                logger.error(f"Помилка оновлення живих результатів: {e}")
+            # RetryAfter у _edit міг відсунути наступне редагування далі, ніж на interval
+            self._last_edit = max(self._last_edit, time.monotonic())
 
-    async def get_worksheet(self, title: str):
-        """Отримує робочий лист (вкладку) за назвою."""
-        if not self.is_connected: return None
+    async def _edit(self, chat_id: int, message_id: int, text: str) -> None:
         try:
-            ws = await asyncio.to_thread(self.sheet.worksheet, title)
-            return ws
-        except gspread.WorksheetNotFound:
-            logger.error(f"❌ Критична помилка: Вкладка '{title}' не знайдена в таблиці '{self.sheet_name}'. Перевірте назви вкладок ('Codes' та 'Votes').")
-            return None
-        except Exception as e:
-            logger.error(f"❌ Помилка при отриманні вкладки '{title}': {e}")
-            return None
+            await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode='Markdown')
+        except RetryAfter as e:
+            retry_after = retry_after_seconds(e)
+            self._last_edit = max(self._last_edit, time.monotonic() + retry_after - self.interval)
+            self._dirty = True
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return
+            # Повідомлення видалено або недоступне — знімаємо підписку
+            logger.warning(f"⚠️ Живі результати: не вдалося оновити повідомлення в чаті {chat_id}: {e}")
+            await self.unsubscribe(chat_id)
+        except Forbidden:
+            await self.unsubscribe(chat_id)
 
-    async def get_all_records(self, worksheet_title: str) -> List[Dict[str, Any]]:
-        """Отримує всі записи з робочого листа."""
-        ws = await self.get_worksheet(worksheet_title)
-        if ws is None: return []
-        try:
-            return await asyncio.to_thread(ws.get_all_records)
-        except Exception as e:
-            logger.error(f"❌ Помилка читання даних з '{worksheet_title}': {e}")
-            return []
+# --- КІЛЬКА ВИБОРІВ В ОДНОМУ ПРОЦЕСІ ---
+def data_path(base: str, data_dir: Optional[str] = None) -> str:
+    """Шлях до файлу стану в каталозі data_dir (без нього — base без змін)."""
+    return os.path.join(data_dir, os.path.basename(base)) if data_dir else base
 
-    async def update_cell(self, worksheet_title: str, row: int, col: int, value: Any):
-        """Оновлює одну клітинку."""
-        ws = await self.get_worksheet(worksheet_title)
-        if ws is None: return False
+def claim_data_dir(data_dir: Optional[str] = None):
+    """Створює каталог стану та блокує його за цим процесом; повертає відкритий файл блокування."""
+    if data_dir:
+        os.makedirs(data_dir, exist_ok=True)
+    lock_file = open(data_path('.votebot.lock', data_dir), 'w')
+    if fcntl is not None:
         try:
-            await asyncio.to_thread(ws.update_cell, row, col, value)
-            return True
-        except Exception as e:
-            logger.error(f"❌ Помилка оновлення клітинки в '{worksheet_title}' (R{row}, C{col}): {e}")
-            return False
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"Каталог стану '{data_dir or os.getcwd()}' вже використовує інший процес бота. "
+                               f"Задайте кожній репліці власний DATA_DIR.")
+    return lock_file
 
-    async def append_row(self, worksheet_title: str, values: List[Any]):
-        """Додає новий рядок."""
-        ws = await self.get_worksheet(worksheet_title)
-        if ws is None: return False
-        try:
-            await asyncio.to_thread(ws.append_row, values)
-            return True
-        except Exception as e:
-            logger.error(f"❌ Помилка додавання рядка до '{worksheet_title}': {e}")
-            return False
-            
-    async def get_all_values(self, worksheet_title: str) -> List[List[Any]]:
-        """Отримує всі значення (включаючи заголовки) з робочого листа."""
-        ws = await self.get_worksheet(worksheet_title)
-        if ws is None: return []
-        try:
-            return await asyncio.to_thread(ws.get_all_values)
-        except Exception as e:
-            logger.error(f"❌ Помилка читання всіх значень з '{worksheet_title}': {e}")
-            return []
+class Election:
+    """Одні вибори: кандидати, класи, таблиця та їхні кеші."""
+    def __init__(self, election_id: str, title: str, sheet_name: str, candidates: Dict[str, str], class_config: Dict[str, int]):
+        if not election_id or not all(char.isalnum() or char in '-_' for char in election_id):
+            raise ValueError(f"Некоректний id виборів '{election_id}': дозволено літери, цифри, '-' та '_'.")
+        self.id = election_id
+        self.title = title
+        self.sheet_name = sheet_name
+        self.candidates = candidates
+        self.class_config = class_config
+        for key in candidates:
+            # Telegram обмежує callback_data 64 байтами
+            if len(self.vote_callback(key).encode('utf-8')) > 64:
+                raise ValueError(f"Задовгий ключ кандидата '{key}' для виборів '{election_id}'.")
 
-# --- ОДНОРАЗОВА ФУНКЦІЯ ГЕНЕРАЦІЇ КОДІВ ---
-async def generate_unique_codes_to_sheets(manager: SheetsManager, config: Dict[str, int]):
-    """
-    Генерує унікальні коди на основі CLASS_CONFIG і записує їх у вкладку 'Codes'.
-    УВАГА: Ця функція очищає всі існуючі записи в таблиці 'Codes' перед записом.
-    """
-    codes_ws = await manager.get_worksheet("Codes")
-    if codes_ws is None: 
-        logger.error("Генерація кодів: Не вдалося отримати вкладку 'Codes'.")
-        return
+        # Заповнюються open_election_storage та setup_bot_state
+        self.sheets: Optional[SheetsManager] = None
+        self.storage: Optional[StorageBackend] = None
+        self.mirror: Optional[SheetsMirror] = None
+        self.code_index: Optional[CodeIndex] = None
+        self.journal: Optional[VoteJournal] = None
+        self.tally: Optional[VoteTally] = None
+        self.offline: Optional[OfflineMode] = None
+        self.live: Optional[LiveResults] = None
 
-    # Очистка старої таблиці (крім заголовків)
-    try:
-        logger.info("Генерація кодів: Очищую існуючі записи...")
-        # Використовуємо методи gspread синхронно через to_thread
-        await asyncio.to_thread(codes_ws.resize, rows=1, cols=7) # Зменшуємо до 1 рядка
-        await asyncio.to_thread(codes_ws.resize, rows=1000) # Повертаємо багато рядків для майбутніх записів
-    except Exception as e:
-        logger.error(f"Генерація кодів: Не вдалося очистити стару таблицю Codes: {e}")
-        # Не зупиняємося, якщо очистка не вдалася, спробуємо оновити заголовки
-        pass
+    @property
+    def online(self) -> bool:
+        """False, поки вибори працюють у резервному режимі без Google Sheets."""
+        return self.offline is None or not self.offline.active
 
-    # Заголовки (на випадок, якщо вони були видалені)
-    await asyncio.to_thread(codes_ws.update, 'A1:G1', [['Class', 'Student_Count', 'Unique_Code', 'Is_Used', 'Telegram_ID', 'Phone_Number', 'Full_Name']])
-    
-    rows_to_insert = []
-    
-    for class_name, count in config.items():
-        for _ in range(count):
-            # Генеруємо 8-значний код на основі UUID
-            unique_code = str(uuid.uuid4()).replace('-', '')[:8].upper()
-            # [Class, Student_Count, Unique_Code, Is_Used, Telegram_ID, Phone_Number, Full_Name]
-            rows_to_insert.append([class_name, count, unique_code, 'FALSE', '', '', ''])
+    @property
+    def available(self) -> bool:
+        return self.storage is not None and (self.storage.is_connected or not self.online)
+
+    def path(self, base: str, data_dir: Optional[str] = None) -> str:
+        """Файл стану виборів: для DEFAULT_ELECTION_ID — base без змін (як з одними виборами), для решти — з id у назві."""
+        base = data_path(base, data_dir)
+        if self.id == DEFAULT_ELECTION_ID:
+            return base
+        stem, ext = os.path.splitext(base)
+        return f"{stem}_{self.id}{ext}"
+
+    def vote_callback(self, candidate_key: str) -> str:
+        return f"vote_{self.id}:{candidate_key}"
+
+def parse_vote_callback(data: str) -> Tuple[Optional[str], str]:
+    """'vote_<вибори>:<кандидат>' -> (id виборів, ключ кандидата); кнопки старого формату 'vote_<кандидат>' — (None, ключ)."""
+    payload = data[len("vote_"):]
+    election_id, separator, candidate_key = payload.partition(':')
+    return (election_id, candidate_key) if separator else (None, payload)
 
-    if rows_to_insert:
+def load_elections(path: str = ELECTIONS_PATH) -> List[Election]:
+    """Читає список виборів з JSON-файлу; без файлу — одні вибори з SHEET_NAME, CANDIDATES та CLASS_CONFIG."""
+    if not path:
+        return [Election(DEFAULT_ELECTION_ID, "Вибори Президента Школи", SHEET_NAME, CANDIDATES, CLASS_CONFIG)]
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    elections = [
+        Election(item['id'], item.get('title', item['id']), item['sheet_name'], item['candidates'], item['class_config'])
+        for item in items
+    ]
+    ids = [election.id for election in elections]
+    if not ids or len(set(ids)) != len(ids):
+        raise ValueError(f"Файл {path} має містити непорожній список виборів з унікальними id.")
+    return elections
+
+def open_election_storage(election: Election, api: SheetsApiClient, backend: str = STORAGE_BACKEND,
+                          data_dir: Optional[str] = None) -> None:
+    """Створює (без підключення) таблицю виборів на спільному клієнті API та основне сховище."""
+    election.sheets = SheetsManager(GSPREAD_SECRET_JSON, election.sheet_name, api=api)
+    if backend == 'sqlite':
+        election.storage = SqliteStorage(election.path(SQLITE_PATH, data_dir))
+        election.mirror = SheetsMirror(election.storage, election.sheets)
+    else:
+        election.storage = election.sheets
+
+def lookup_code(elections: Iterable[Election], code: str) -> Tuple[Optional[Election], Optional[CodeEntry]]:
+    """Шукає код в індексах усіх виборів."""
+    for election in elections:
+        entry = election.code_index.lookup(code)
+        if entry is not None:
+            return election, entry
+    return None, None
+
+# --- ГОТОВНІСТЬ ДО РОБОТИ ---
+class Readiness:
+    """Стан фонового запуску бота."""
+    def __init__(self):
+        self._event = asyncio.Event()
+        self.started_at = time.monotonic()
+        self.listening_after: Optional[float] = None
+        self.ready_after: Optional[float] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self._event.is_set()
+
+    def mark_listening(self) -> None:
+        self.listening_after = time.monotonic() - self.started_at
+        logger.info(f"⏱️ Порт відкрито через {self.listening_after:.3f} с після старту.")
+
+    def mark_ready(self) -> None:
+        self.ready_after = time.monotonic() - self.started_at
+        self._event.set()
+        logger.info(f"⏱️ Бот готовий до роботи через {self.ready_after:.3f} с після старту.")
+
+    async def wait(self, timeout: float = READINESS_WAIT) -> bool:
+        """Чекає на готовність не довше timeout. Повертає True, якщо бот готовий."""
+        if self._event.is_set():
+            return True
         try:
-            # Масове оновлення даних
-            await asyncio.to_thread(codes_ws.append_rows, rows_to_insert)
-            logger.info(f"✅ Генерація кодів: Успішно згенеровано та записано {len(rows_to_insert)} унікальних кодів.")
-        except Exception as e:
-            logger.error(f"❌ Генерація кодів: Помилка масового запису кодів: {e}")
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
 # --- ФУНКЦІЇ БОТА (start, receive_code, receive_contact, handle_vote, show_results, cancel) ---
 
+def session_election(context: ContextTypes.DEFAULT_TYPE) -> Election:
+    """Вибори поточної розмови (сесії без виборів, розпочаті до появи кількох виборів, належать першим)."""
+    elections: Dict[str, Election] = context.bot_data['elections']
+    return elections.get(context.session.election) or next(iter(elections.values()))
+
+def admin_elections(context: ContextTypes.DEFAULT_TYPE, args: List[str]) -> Tuple[List[Election], List[str]]:
+    """Перший аргумент адмін-команди може бути id виборів: повертає (вибори, решта аргументів). Без id — усі вибори."""
+    elections: Dict[str, Election] = context.bot_data['elections']
+    if args and args[0] in elections:
+        return [elections[args[0]]], list(args[1:])
+    return list(elections.values()), list(args)
+
+@voter_session(None)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Початкова точка, просить користувача ввести унікальний код."""
+    """Початкова точка, просить користувача ввести унікальний код. /start <id виборів> одразу обирає вибори."""
     user = update.effective_user
-    manager: SheetsManager = context.bot_data.get('sheets_manager')
-    
-    if not manager or not manager.is_connected:
+    elections: Dict[str, Election] = context.bot_data.get('elections')
+    readiness: Readiness = context.bot_data.get('readiness')
+
+    # Одні вибори обираються одразу, кілька — посиланням /start <id> або пізніше за введеним кодом
+    session: VoterSession = context.session
+    if context.args and context.args[0] in elections:
+        election_id = context.args[0]
+    else:
+        election_id = next(iter(elections)) if len(elections) == 1 else None
+    if session.election != election_id:
+        reservations: CodeReservations = context.bot_data.get('code_reservations')
+        await reservations.release(session.key, user.id)
+        session.election, session.code, session.row = election_id, None, None
+
+    scope = [elections[election_id]] if election_id else list(elections.values())
+    if not await readiness.wait() or not any(election.available for election in scope):
         await update.message.reply_text("❌ Вибачте, сервіс голосування тимчасово недоступний. Спробуйте пізніше.")
         return ConversationHandler.END
 
@@ -206,98 +2572,132 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return WAITING_FOR_CODE
 
+@voter_session(WAITING_FOR_CODE)
 async def receive_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробляє введений код, перевіряє його валідність та статус."""
     code = update.message.text.strip().upper()
-    manager: SheetsManager = context.bot_data.get('sheets_manager')
+    elections: Dict[str, Election] = context.bot_data.get('elections')
+    session: VoterSession = context.session
 
-    if len(code) != 8:
-        await update.message.reply_text("❌ Код має складатися рівно з 8 символів. Спробуйте ще раз.")
+    if len(code) != CODE_LENGTH:
+        await update.message.reply_text(f"❌ Код має складатися рівно з {CODE_LENGTH} символів. Спробуйте ще раз.")
         return WAITING_FOR_CODE
 
-    codes_values = await manager.get_all_values("Codes")
-    if not codes_values:
+    # Код шукаємо у виборах, обраних посиланням /start <id>, або в усіх виборах процесу.
+    # У резервному режимі коди перевіряються за локальним індексом без звернень до Sheets
+    scope = [elections[session.election]] if session.election in elections else list(elections.values())
+    await asyncio.gather(*[election.code_index.ensure_fresh() for election in scope if election.online])
+    if not any(election.code_index.is_loaded for election in scope):
         await update.message.reply_text("❌ Виникла помилка при доступі до бази кодів. Спробуйте пізніше.")
         return ConversationHandler.END
 
-    # Знаходимо код
-    header = codes_values[0]
-    data_rows = codes_values[1:]
+    # Знаходимо код в індексах (O(1) для кожних виборів, без звернень до API)
+    election, entry = lookup_code(scope, code)
+    if entry is None:
+        # Код міг бути доданий вручну після останнього оновлення індексу — дочитуємо лише нові рядки
+        stale = [item for item in scope if item.online and item.code_index.read_age > CODE_INDEX_MISS_REFRESH]
+        if stale:
+            await asyncio.gather(*[item.code_index.refresh_appended() for item in stale])
+            election, entry = lookup_code(scope, code)
 
-    context.user_data['code_row_index'] = None
-    context.user_data['code_info'] = None
-    
-    # Індекси колонок
-    col_code = header.index('Unique_Code') + 1
-    col_is_used = header.index('Is_Used') + 1
-
-    for i, row in enumerate(data_rows):
-        # i + 2, оскільки індексація gspread починається з 1, і ми пропускаємо рядок заголовків
-        row_num = i + 2
-        
-        if row[col_code - 1] == code:
-            # Знайдено код
-            context.user_data['code_row_index'] = row_num
-            context.user_data['code_info'] = dict(zip(header, row))
-            
-            if row[col_is_used - 1].upper() == 'TRUE':
-                await update.message.reply_text("❌ Цей код вже був використаний для голосування.")
-                return WAITING_FOR_CODE
-            
-            # Код валідний та не використаний. Просимо номер телефону.
-            context.user_data['unique_code'] = code
-            
-            keyboard = [[KeyboardButton("Надіслати мій номер телефону", request_contact=True)]]
-            await update.message.reply_text(
-                "✅ Код прийнято! Для підтвердження вашої особи, будь ласка, **надішліть свій номер телефону** через кнопку нижче. Це потрібно для ідентифікації.",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-            )
-            return WAITING_FOR_CONTACT
+    if entry is None:
+        await update.message.reply_text("❌ Невірний унікальний код. Спробуйте ще раз.")
+        return WAITING_FOR_CODE
 
-    # Якщо цикл завершився і код не знайдено
-    await update.message.reply_text("❌ Невірний унікальний код. Спробуйте ще раз.")
-    return WAITING_FOR_CODE
+    if entry.is_used:
+        await update.message.reply_text("❌ Цей код вже був використаний для голосування.")
+        return WAITING_FOR_CODE
+
+    # Атомарно резервуємо код (у межах його виборів), щоб його не могли одночасно використати в іншій розмові
+    reservations: CodeReservations = context.bot_data.get('code_reservations')
+    key = f"{election.id}:{code}"
+    previous_key = session.key
+    if previous_key and previous_key != key:
+        await reservations.release(previous_key, update.effective_user.id)
+    reservation = await reservations.reserve(key, update.effective_user.id)
+    if reservation == CodeReservations.USED:
+        election.code_index.mark_used(code)
+        await update.message.reply_text("❌ Цей код вже був використаний для голосування.")
+        return WAITING_FOR_CODE
+    if reservation == CodeReservations.BUSY:
+        await update.message.reply_text("❌ Цей код зараз використовується в іншій розмові. Спробуйте пізніше або введіть інший код.")
+        return WAITING_FOR_CODE
+
+    # Код валідний та не використаний. Просимо номер телефону.
+    session.election, session.code, session.row, session.class_name = election.id, code, entry.row, entry.class_name
+
+    keyboard = [[KeyboardButton("Надіслати мій номер телефону", request_contact=True)]]
+    await update.message.reply_text(
+        "✅ Код прийнято! Для підтвердження вашої особи, будь ласка, **надішліть свій номер телефону** через кнопку нижче. Це потрібно для ідентифікації.",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    )
+    return WAITING_FOR_CONTACT
 
+@voter_session(WAITING_FOR_CONTACT)
 async def receive_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробляє отриманий контакт (номер телефону) та пропонує голосувати."""
     contact = update.message.contact
     user = update.effective_user
-    manager: SheetsManager = context.bot_data.get('sheets_manager')
+    election = session_election(context)
+    manager: StorageBackend = election.storage
     
     if contact.user_id != user.id:
         await update.message.reply_text("❌ Будь ласка, надішліть саме свій номер телефону, використовуючи кнопку.")
         return WAITING_FOR_CONTACT
 
     # 1. Оновлюємо рядок у таблиці Codes
-    row_num = context.user_data.get('code_row_index')
+    session: VoterSession = context.session
+    row_num = session.row
+    code = session.code
+    reservations: CodeReservations = context.bot_data.get('code_reservations')
     
     if row_num:
-        try:
-            codes_ws = await manager.get_worksheet("Codes")
-            # Використовуємо .find() для пошуку колонок для надійності
-            col_is_used = await asyncio.to_thread(codes_ws.find, "Is_Used")
-            col_tg_id = await asyncio.to_thread(codes_ws.find, "Telegram_ID")
-            col_phone = await asyncio.to_thread(codes_ws.find, "Phone_Number")
-            col_full_name = await asyncio.to_thread(codes_ws.find, "Full_Name")
-            
-            if all([col_is_used, col_tg_id, col_phone, col_full_name]):
-                await asyncio.to_thread(codes_ws.update_cell, row_num, col_is_used.col, 'TRUE')
-                await asyncio.to_thread(codes_ws.update_cell, row_num, col_tg_id.col, user.id)
-                await asyncio.to_thread(codes_ws.update_cell, row_num, col_phone.col, contact.phone_number)
-                await asyncio.to_thread(codes_ws.update_cell, row_num, col_full_name.col, f"{user.full_name} (@{user.username or 'N/A'})")
-            else:
-                logger.error("Не знайдено одну з необхідних колонок у вкладці Codes.")
-                raise Exception("Проблема з колонками Sheets.")
-                
-        except Exception as e:
-            logger.error(f"Помилка оновлення рядка коду: {e}")
-            await update.message.reply_text("❌ Виникла помилка під час фіксації реєстрації. Зверніться до адміністратора.")
-            return ConversationHandler.END
+        # Реєстрація коду виконується під його замком і лише поки резервування належить цьому користувачу
+        async with reservations.lock(session.key):
+            if not await reservations.holds(session.key, user.id):
+                await update.message.reply_text("❌ Час резервування коду минув. Почніть спочатку командою /start.")
+                return ConversationHandler.END
+
+            registered = False
+            offline = election.offline
+            fields = {
+                'Is_Used': 'TRUE',
+                'Telegram_ID': user.id,
+                'Phone_Number': contact.phone_number,
+                'Full_Name': f"{user.full_name} (@{user.username or 'N/A'})",
+            }
+            try:
+                if not election.online:
+                    # Резервний режим: реєстрація чекає в локальній черзі на відновлення зв'язку з Sheets
+                    registered = await offline.queue_registration(code, row_num, fields)
+                else:
+                    # Усі поля реєстрації записуються одним запитом batch_update (без напівзаписаних рядків)
+                    registered = await manager.update_row_fields("Codes", row_num, fields)
+                    if not registered and offline is not None:
+                        offline.enter("не вдалося записати реєстрацію")
+                        registered = offline.active and await offline.queue_registration(code, row_num, fields)
 
-    # 2. Формуємо кнопки для голосування
+                if registered:
+                    election.code_index.mark_used(code)
+                else:
+                    logger.error("Не вдалося записати реєстрацію у вкладку Codes.")
+                    raise Exception("Проблема із записом у Sheets.")
+
+            except Exception as e:
+                logger.error(f"Помилка оновлення рядка коду: {e}")
+                await update.message.reply_text("❌ Виникла помилка під час фіксації реєстрації. Зверніться до адміністратора.")
+                return ConversationHandler.END
+            finally:
+                # Після запису код позначено використаним, резервування більше не потрібне
+                if registered:
+                    await reservations.commit(session.key, user.id)
+                else:
+                    await reservations.release(session.key, user.id)
+
+    # 2. Формуємо кнопки для голосування (callback_data містить id виборів)
     keyboard = []
-    for key, value in CANDIDATES.items():
-        keyboard.append([InlineKeyboardButton(value, callback_data=f"vote_{key}")])
+    for key, value in election.candidates.items():
+        keyboard.append([InlineKeyboardButton(value, callback_data=election.vote_callback(key))])
 
     await update.message.reply_text(
         "🤝 Реєстрація успішна! Тепер ви можете віддати свій єдиний голос. **Зробіть свій вибір:**",
@@ -305,99 +2705,213 @@ async def receive_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return WAITING_FOR_VOTE
 
+@voter_session(WAITING_FOR_VOTE)
 async def handle_vote(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обробляє вибір кандидата та фіксує голос."""
     query = update.callback_query
+    election = session_election(context)
+
+    # Витягуємо вибори та ключ кандидата (наприклад, "school" та "Viktoriia Kochut")
+    election_id, candidate_key = parse_vote_callback(query.data)
+    if election_id is not None and election_id != election.id:
+        # Кнопка з повідомлення інших виборів: розмова триває, голос чекає на кнопку поточних виборів
+        await query.answer("❌ Ця кнопка належить іншим виборам.", show_alert=True)
+        return WAITING_FOR_VOTE
     await query.answer()
 
-    manager: SheetsManager = context.bot_data.get('sheets_manager')
+    journal = election.journal
     user = query.from_user
+    candidate_name = election.candidates.get(candidate_key, UNKNOWN_CANDIDATE)
     
-    # Витягуємо ключ кандидата (наприклад, "Viktoriia Kochut")
-    candidate_key = query.data.replace("vote_", "")
-    candidate_name = CANDIDATES.get(candidate_key, "Невідомий кандидат")
-    
-    code_info = context.user_data.get('code_info', {})
+    session: VoterSession = context.session
+
+    # Кілька реплік: голос з одним кодом зараховується лише один раз (ключ ідемпотентності)
+    shared: Optional[SharedState] = context.bot_data.get('shared_state')
+    unique_code = session.code
+    if shared and unique_code and not await shared.claim_vote(session.key):
+        await query.edit_message_text("✅ Ваш голос уже зараховано раніше.", reply_markup=None)
+        return ConversationHandler.END
 
-    # 1. Записуємо голос у вкладку Votes
+    # 1. Записуємо голос у локальний журнал виборів (у вкладку Votes його перенесе фонова задача)
     vote_data = [
         datetime.now().isoformat(),
-        code_info.get('Class', 'N/A'),
-        context.user_data.get('unique_code', 'N/A'),
+        session.class_name or 'N/A',
+        unique_code or 'N/A',
         user.id,
         user.username or 'N/A',
         user.full_name,
         candidate_name
     ]
     
-    success = await manager.append_row("Votes", vote_data)
+    success = await journal.append(vote_data)
 
     if success:
+        election.tally.record(str(vote_data[1]), candidate_name)
+        if shared:
+            await shared.record_vote(election, str(vote_data[1]), candidate_name)
+        election.live.notify()
         await query.edit_message_text(
             f"✅ **Ваш голос зараховано!**\n\nВи проголосували за **{candidate_name}**.",
             reply_markup=None,
             parse_mode='Markdown'
         )
     else:
+        if shared and unique_code:
+            await shared.release_vote(session.key)
         await query.edit_message_text("❌ Виникла помилка під час фіксації вашого голосу. Зверніться до адміністратора.")
 
-    # Очистка даних користувача
-    context.user_data.clear()
+    # Розмову завершено: сесію користувача буде видалено
     return ConversationHandler.END
 
 async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Адміністративна команда: виводить результати голосування у відсотках."""
+    """Адміністративна команда: /result [id виборів] [full] — результати голосування у відсотках."""
     user = update.effective_user
-    manager: SheetsManager = context.bot_data.get('sheets_manager')
 
     if user.id not in ADMIN_IDS:
         await update.message.reply_text("❌ Ця команда доступна лише адміністраторам.")
         return
 
-    await update.message.reply_text("⏳ Збираю та аналізую результати...")
+    # 1. Беремо підрахунок з пам'яті; "/result full" примусово звіряє його з таблицею
+    targets, args = admin_elections(context, context.args)
+    force_reconcile = bool(args) and args[0].lower() == 'full'
+    shared: Optional[SharedState] = context.bot_data.get('shared_state')
+    for election in targets:
+        tally = election.tally
+        if force_reconcile or not tally.is_seeded:
+            await update.message.reply_text(f"⏳ Збираю та аналізую результати ({election.title})...")
+            if not await tally.reconcile():
+                await update.message.reply_text(f"❌ Не вдалося прочитати вкладку Votes ({election.title}). Спробуйте пізніше.")
+                continue
+            if shared and force_reconcile:
+                await shared.publish_tally(election)
+        if shared:
+            # Кілька реплік: голоси, зараховані іншими репліками, є лише у спільних лічильниках
+            await shared.load_tally(election)
+
+        if tally.total == 0:
+            await update.message.reply_text(f"📊 {election.title}: наразі жодного голосу не зафіксовано.")
+            continue
 
-    # 1. Отримуємо всі голоси
-    votes_data = await manager.get_all_records("Votes")
-    if not votes_data:
-        await update.message.reply_text("📊 Наразі жодного голосу не зафіксовано.")
+        await update.message.reply_text(format_results(election), parse_mode='Markdown')
+
+async def live_results(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Адміністративна команда: /live [id виборів] [stop] — жива панель результатів."""
+    user = update.effective_user
+
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Ця команда доступна лише адміністраторам.")
         return
 
-    total_votes = len(votes_data)
-    vote_counts: Dict[str, int] = {}
+    chat_id = update.effective_chat.id
+    targets, args = admin_elections(context, context.args)
+    if args and args[0].lower() == 'stop':
+        stopped = [election for election in targets if await election.live.unsubscribe(chat_id)]
+        if stopped:
+            await update.message.reply_text("⏹️ Живі результати вимкнено.")
+        else:
+            await update.message.reply_text("Живі результати не були увімкнені.")
+        return
 
-    # 2. Підраховуємо голоси за кандидатів
-    for vote in votes_data:
-        candidate = vote.get('Candidate_Voted', 'Невідомий')
-        vote_counts[candidate] = vote_counts.get(candidate, 0) + 1
+    subscribed = 0
+    for election in targets:
+        if not election.tally.is_seeded and not await election.tally.reconcile():
+            await update.message.reply_text(f"❌ Не вдалося прочитати вкладку Votes ({election.title}). Спробуйте пізніше.")
+            continue
+        await election.live.subscribe(chat_id)
+        subscribed += 1
 
-    # 3. Формуємо вивід результатів
-    results_text = f"📊 **Результати Виборів Президента Школи**\n\n"
-    results_text += f"Всього зарахованих голосів: **{total_votes}**\n\n"
-    
-    sorted_results = sorted(vote_counts.items(), key=lambda item: item[1], reverse=True)
-    
-    for candidate, count in sorted_results:
-        percentage = (count / total_votes) * 100 if total_votes > 0 else 0
-        
-        # Створюємо простий графік за допомогою емодзі
-        blocks = int(percentage / 10)
-        chart = '█' * blocks + '░' * (10 - blocks)
-        
-        results_text += (
-            f"**{candidate}**:\n"
-            f"   {count} голосів ({percentage:.2f}%)\n"
-            f"   `{chart}`\n"
+    if subscribed:
+        await update.message.reply_text(
+            f"🔴 Живі результати увімкнено: закріплене повідомлення оновлюватиметься не частіше ніж раз на "
+            f"{targets[0].live.interval:g} с. Вимкнути: /live stop"
+        )
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Адміністративна команда: /broadcast <registered|unvoted|voted> <текст> | status | resume."""
+    user = update.effective_user
+    broadcaster: Broadcaster = context.bot_data.get('broadcaster')
+
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Ця команда доступна лише адміністраторам.")
+        return
+
+    parts = update.message.text.split(maxsplit=2)
+    action = parts[1].lower() if len(parts) > 1 else ''
+
+    if action == 'status':
+        if not broadcaster.header:
+            await update.message.reply_text("📣 Розсилок ще не було.")
+            return
+        counts = broadcaster.counts()
+        state = "триває" if broadcaster.is_running else "зупинена"
+        await update.message.reply_text(
+            f"📣 Розсилка {state}: надіслано {counts[Broadcaster.SENT]}, заблокували бота {counts[Broadcaster.BLOCKED]}, "
+            f"помилок {counts[Broadcaster.FAILED]}, у черзі {len(broadcaster.pending)}."
+        )
+        return
+
+    if broadcaster.is_running:
+        await update.message.reply_text("⏳ Розсилка вже триває. Перевірити прогрес: /broadcast status")
+        return
+
+    if action == 'resume':
+        if not broadcaster.load():
+            await update.message.reply_text("📣 Незавершених розсилок немає.")
+            return
+        broadcaster.resume()
+        await update.message.reply_text(f"📣 Продовжую розсилку: залишилось {len(broadcaster.pending)} отримувачів.")
+        return
+
+    if action not in BROADCAST_AUDIENCES or len(parts) < 3:
+        audiences = '|'.join(BROADCAST_AUDIENCES)
+        await update.message.reply_text(
+            f"Використання: /broadcast <{audiences}> <текст>\n/broadcast status\n/broadcast resume"
         )
-        
-    await update.message.reply_text(results_text, parse_mode='Markdown')
+        return
+
+    elections: Dict[str, Election] = context.bot_data.get('elections')
+    recipients = await collect_broadcast_recipients(elections.values(), action)
+    if recipients is None:
+        await update.message.reply_text("❌ Не вдалося прочитати таблицю для формування списку отримувачів.")
+        return
+    if not recipients:
+        await update.message.reply_text("📣 Немає жодного отримувача для цієї розсилки.")
+        return
+
+    broadcaster.start(parts[2], recipients, action, update.effective_chat.id)
+    minutes = len(recipients) / broadcaster.bucket.rate / 60
+    await update.message.reply_text(
+        f"📣 Розсилка {BROADCAST_AUDIENCES[action]}: {len(recipients)} отримувачів (орієнтовно {minutes:.1f} хв). "
+        f"Про завершення повідомлю окремо."
+    )
+
+async def reload_codes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Адміністративна команда: /reload_codes [id виборів] — примусово перечитує вкладку 'Codes' в індекс кодів."""
+    user = update.effective_user
+
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Ця команда доступна лише адміністраторам.")
+        return
+
+    targets, _ = admin_elections(context, context.args)
+    refreshed = await asyncio.gather(*[election.code_index.refresh() for election in targets])
+    lines = []
+    for election, ok in zip(targets, refreshed):
+        if ok:
+            lines.append(f"✅ Індекс кодів оновлено ({election.title}): {len(election.code_index)} кодів.")
+        else:
+            lines.append(f"❌ Не вдалося оновити індекс кодів ({election.title}). Перевірте доступ до Google Sheets.")
+    await update.message.reply_text("\n".join(lines))
 
+@voter_session(None)
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Скасовує активну розмову."""
+    reservations: CodeReservations = context.bot_data.get('code_reservations')
+    await reservations.release(context.session.key, update.effective_user.id)
     await update.effective_message.reply_text(
         'Операцію скасовано.',
         reply_markup=ReplyKeyboardRemove()
     )
-    context.user_data.clear()
     return ConversationHandler.END
 
 # --- WEBHOOK ТА KEEP-ALIVE ---
@@ -415,6 +2929,119 @@ async def init_webhook(application: Application, url: str) -> None:
         except Exception as e:
             logger.error(f"Не вдалося встановити вебхук: {e}")
 
+class UpdateDispatcher:
+    """Обробка оновлень поза вебхуком: по черзі для кожного користувача, паралельно (до workers) для різних."""
+    def __init__(self, application: Application, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.application = application
+        self.workers = workers
+        self.queue_size = queue_size
+        self._semaphore = asyncio.Semaphore(workers)
+        # Ключ користувача (чату) -> оновлення, що чекають на обробку; ланцюжок видаляється, щойно спорожніє
+        self._chains: Dict[Hashable, deque] = {}
+        self._tasks: set = set()
+        self._queued = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def queue_depth(self) -> int:
+        """Прийняті оновлення, обробка яких ще не почалася."""
+        return self._queued
+
+    def submit(self, update: Update) -> bool:
+        """Ставить оновлення в ланцюжок його користувача. Повертає False, якщо черга заповнена."""
+        if self._queued >= self.queue_size:
+            return False
+        if update.effective_user is not None:
+            key = update.effective_user.id
+        elif update.effective_chat is not None:
+            key = update.effective_chat.id
+        else:
+            key = update.update_id
+        self._queued += 1
+        self._idle.clear()
+        chain = self._chains.get(key)
+        if chain is not None:
+            chain.append(update)
+            return True
+        self._chains[key] = deque([update])
+        task = asyncio.create_task(self._run_chain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    def start(self) -> None:
+        logger.info(f"Обробка оновлень вебхука: до {self.workers} одночасно, черга до {self.queue_size}.")
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Дочікується обробки вже прийнятих оновлень (не довше timeout) і скасовує решту."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Не всі оновлення оброблено до зупинки: {self.queue_depth} у черзі.")
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _run_chain(self, key: Hashable) -> None:
+        readiness: Readiness = self.application.bot_data['readiness']
+        chain = self._chains[key]
+        try:
+            while chain:
+                update = chain.popleft()
+                # Оновлення, прийняті до завершення запуску, обробляються одразу після нього
+                while not await readiness.wait():
+                    pass
+                async with self._semaphore:
+                    self._queued -= 1
+                    try:
+                        await self.application.process_update(update)
+                    except Exception as e:
+                        logger.error(f"Помилка обробки оновлення {update.update_id}: {e}")
+        finally:
+            del self._chains[key]
+            if not self._chains:
+                self._idle.set()
+
+# Розбір тіла вебхука: orjson, якщо встановлено, інакше стандартний json
+json_loads = orjson.loads if orjson is not None else json.loads
+
+class WebhookFilter:
+    """Відкидає непотрібні та повторні оновлення ще до розбору JSON у Update."""
+    def __init__(self, capacity: int = WEBHOOK_DEDUP_SIZE):
+        self.capacity = capacity
+        self._seen: set = set()
+        self._order: deque = deque()
+        self.dropped_irrelevant = 0
+        self.dropped_duplicate = 0
+
+    @staticmethod
+    def is_relevant(data: Dict[str, Any]) -> bool:
+        # Обробники бота приймають лише текст (команди та коди), контакт і кнопки голосування
+        message = data.get('message') or data.get('edited_message')
+        if message is not None:
+            return 'text' in message or 'contact' in message
+        callback_query = data.get('callback_query')
+        if callback_query is not None:
+            return str(callback_query.get('data', '')).startswith('vote_')
+        return False
+
+    def accept(self, data: Dict[str, Any]) -> bool:
+        """Повертає True, якщо оновлення варто розбирати й обробляти."""
+        if data.get('update_id') in self._seen:
+            self.dropped_duplicate += 1
+            return False
+        if not self.is_relevant(data):
+            self.dropped_irrelevant += 1
+            return False
+        return True
+
+    def remember(self, update_id: int) -> None:
+        """Запам'ятовує прийняте оновлення (лише після успішної постановки в обробку)."""
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.capacity:
+            self._seen.discard(self._order.popleft())
+
 async def keep_alive_task(app: web.Application):
     """
     Задача для підтримки активності сервера (Keep-Alive).
@@ -440,13 +3067,91 @@ async def status_handler(request: web.Request) -> web.Response:
     """Endpoint для перевірки статусу (використовується Keep-Alive)."""
     return web.Response(text="Bot is running", status=200)
 
+async def ready_handler(request: web.Request) -> web.Response:
+    """Endpoint готовності: 200 після завершення фонового запуску, до того — 503."""
+    readiness: Readiness = request.app['ptb_app'].bot_data['readiness']
+    if readiness.is_ready:
+        return web.Response(text="Ready", status=200)
+    return web.Response(text="Starting", status=503)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Endpoint з метриками у текстовому форматі Prometheus."""
+    return web.Response(text=await METRICS.render(), content_type='text/plain', charset='utf-8')
+
+def register_runtime_gauges(application: Application, dispatcher: Optional['UpdateDispatcher'],
+                            webhook_filter: Optional[WebhookFilter] = None) -> None:
+    """Реєструє gauge-метрики, що обчислюються зі стану бота в момент запиту /metrics."""
+    readiness: Optional[Readiness] = application.bot_data.get('readiness')
+    if readiness is not None:
+        METRICS.gauge('votebot_ready', 'Чи завершено фоновий запуск (1 — так).', lambda: float(readiness.is_ready))
+        METRICS.gauge('votebot_time_to_listening_seconds', 'Час від старту процесу до відкриття порту.',
+                      lambda: readiness.listening_after or 0.0)
+        METRICS.gauge('votebot_time_to_ready_seconds', 'Час від старту процесу до готовності обробляти оновлення.',
+                      lambda: readiness.ready_after or 0.0)
+    sheets_api: Optional[SheetsApiClient] = application.bot_data.get('sheets_api')
+    if sheets_api is not None:
+        METRICS.gauge('votebot_sheets_executor_queue_depth', 'Виклики Sheets API, що чекають на вільний потік.',
+                      lambda: sheets_api.queue_depth)
+        METRICS.gauge('votebot_sheets_calls_in_flight', 'Виклики Sheets API, що виконуються зараз.',
+                      lambda: sheets_api.in_flight_calls - sheets_api.queue_depth)
+    shared: Optional[SharedState] = application.bot_data.get('shared_state')
+    sessions: Optional[SessionStore] = application.bot_data.get('sessions')
+    if shared is not None:
+        # Розмови всіх реплік живуть у спільному сховищі
+        METRICS.gauge('votebot_active_conversations', 'Незавершені розмови голосування.', shared.active_sessions)
+    elif sessions is not None:
+        METRICS.gauge('votebot_active_conversations', 'Незавершені розмови голосування.', lambda: len(sessions))
+    if shared is None:
+        # У режимі спільного стану резерви кодів живуть у сховищі KV, а не в пам'яті процесу
+        reservations: Optional[CodeReservations] = application.bot_data.get('code_reservations')
+        if reservations is not None:
+            METRICS.gauge('votebot_code_reservations', 'Коди, зарезервовані в активних розмовах.', lambda: len(reservations))
+    elections: List[Election] = list(application.bot_data.get('elections', {}).values())
+    if elections:
+        # Значення сумуються за всіма виборами процесу
+        METRICS.gauge('votebot_elections', 'Кількість виборів, які обслуговує процес.', lambda: float(len(elections)))
+        METRICS.gauge('votebot_vote_journal_pending', 'Голоси в журналах, ще не перенесені у вкладки Votes.',
+                      lambda: sum(election.journal.pending_count for election in elections))
+    offline_modes = [election.offline for election in elections if election.offline is not None]
+    if offline_modes:
+        METRICS.gauge('votebot_offline_mode', 'Кількість виборів у резервному режимі без Google Sheets.',
+                      lambda: float(sum(offline.active for offline in offline_modes)))
+        METRICS.gauge('votebot_offline_queue', 'Реєстрації в локальних чергах, ще не записані в Sheets.',
+                      lambda: sum(offline.pending_count for offline in offline_modes))
+    if dispatcher is not None:
+        METRICS.gauge('votebot_webhook_queue_depth', 'Прийняті оновлення Telegram, обробка яких ще не почалася.', lambda: dispatcher.queue_depth)
+    if webhook_filter is not None:
+        METRICS.gauge('votebot_webhook_dropped_irrelevant', 'Оновлення, відкинуті до розбору: жоден обробник їх не приймає.',
+                      lambda: webhook_filter.dropped_irrelevant)
+        METRICS.gauge('votebot_webhook_dropped_duplicate', 'Повторні доставки вже прийнятих update_id.',
+                      lambda: webhook_filter.dropped_duplicate)
+
 async def handle_telegram_webhook(request: web.Request) -> web.Response:
     """Обробляє вхідні оновлення від Telegram."""
     application = request.app['ptb_app']
     try:
-        data = await request.json()
+        data = json_loads(await request.read())
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        # Непотрібні та повторні оновлення відкидаються до побудови об'єктів (відповідь 200 — без повторів)
+        webhook_filter: WebhookFilter = request.app['webhook_filter']
+        if not webhook_filter.accept(data):
+            return web.Response()
+
         update = Update.de_json(data, application.bot)
-        await application.process_update(update)
+        dispatcher: Optional[UpdateDispatcher] = request.app.get('update_dispatcher')
+        if dispatcher is None:
+            # Поки бот запускається, Telegram отримає 503 і повторить доставку — оновлення не губиться
+            if not await application.bot_data['readiness'].wait():
+                return web.Response(status=503, headers={'Retry-After': '5'})
+            webhook_filter.remember(update.update_id)
+            await application.process_update(update)
+        elif not dispatcher.submit(update):
+            # Черга заповнена: Telegram повторить доставку пізніше
+            logger.warning(f"⚠️ Черга оновлень заповнена, відхиляю оновлення {update.update_id}.")
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        else:
+            webhook_filter.remember(update.update_id)
         return web.Response()
     except json.JSONDecodeError:
         logger.warning("Не вдалося розпарсити JSON з вебхука Telegram.")
@@ -455,52 +3160,198 @@ async def handle_telegram_webhook(request: web.Request) -> web.Response:
         logger.error(f"Помилка в обробнику вебхука: {e}")
         return web.Response(status=500)
 
+# --- ЗБІРКА ЗАСТОСУНКУ ---
+
+def build_application(token: str = TELEGRAM_BOT_TOKEN, request: Optional[BaseRequest] = None) -> Application:
+    """Створює Application з усіма обробниками."""
+    builder = Application.builder().token(token)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
+
+    # --- Розмова голосування ---
+    # Стан розмови зберігається лише в сесії виборця (SessionStore або спільне сховище реплік):
+    # voter_session пропускає оновлення, що не відповідають поточному кроку, тож ConversationHandler не потрібен
+    application.add_handler(CommandHandler("start", instrumented(start)))
+    application.add_handler(CommandHandler("cancel", instrumented(cancel)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(receive_code)))
+    # Фільтр для кнопки "Надіслати контакт"
+    application.add_handler(MessageHandler(filters.CONTACT, instrumented(receive_contact)))
+    application.add_handler(CallbackQueryHandler(instrumented(handle_vote), pattern='^vote_.*$'))
+    application.add_handler(CommandHandler("result", instrumented(show_results))) # Адмін-команда
+    application.add_handler(CommandHandler("reload_codes", instrumented(reload_codes))) # Адмін-команда
+    application.add_handler(CommandHandler("broadcast", instrumented(broadcast))) # Адмін-команда
+    application.add_handler(CommandHandler("live", instrumented(live_results))) # Адмін-команда
+    return application
+
+async def setup_bot_state(application: Application, elections: List[Election], shared_state_url: str = SHARED_STATE_URL,
+                          data_dir: Optional[str] = None) -> None:
+    """Створює стан бота в bot_data."""
+    application.bot_data.setdefault('readiness', Readiness())
+    shared: Optional[SharedState] = None
+    if shared_state_url:
+        kv = open_key_value_store(shared_state_url)
+        shared = application.bot_data['shared_state'] = SharedState(kv, CONVERSATION_TIMEOUT)
+        application.bot_data['code_reservations'] = SharedCodeReservations(kv, CONVERSATION_TIMEOUT)
+        logger.info(f"🔗 Спільний стан реплік: {shared_state_url.split('://')[0]}://")
+    else:
+        application.bot_data['code_reservations'] = CodeReservations(CONVERSATION_TIMEOUT)
+    application.bot_data['sessions'] = SessionStore(CONVERSATION_TIMEOUT)
+
+    for election in elections:
+        storage = election.storage
+        # --- Індекс кодів: завантажується при прогріві, далі оновлюється у фоні ---
+        # Для Google Sheets індекс зберігається у знімок на диску: з нього бот стартує, якщо Sheets недоступна
+        is_sheets = isinstance(storage, SheetsManager)
+        snapshot_path = election.path(CODE_SNAPSHOT_PATH, data_dir) if is_sheets else None
+        election.code_index = CodeIndex(storage, snapshot_path=snapshot_path)
+        if snapshot_path:
+            election.code_index.load_snapshot(snapshot_path)
+        if is_sheets:
+            election.offline = OfflineMode(storage, election.code_index, election.path(OFFLINE_QUEUE_PATH, data_dir))
+            election.offline.load()
+
+        # --- Журнал голосів: дозаписуємо голоси, не перенесені до попередньої зупинки ---
+        election.journal = VoteJournal(storage, election.path(VOTE_JOURNAL_PATH, data_dir))
+        election.journal.load()
+
+        # --- Підрахунок голосів: заповнюється при прогріві, далі оновлюється при кожному голосі ---
+        election.tally = VoteTally(storage, election.journal)
+
+        # --- Живі результати: підписки адміністраторів переживають перезапуск ---
+        election.live = LiveResults(application.bot, election, election.path(LIVE_RESULTS_PATH, data_dir))
+        election.live.shared = shared
+        election.live.load()
+    application.bot_data['elections'] = {election.id: election for election in elections}
+
+    # --- Розсилка: незавершену до перезапуску можна продовжити командою /broadcast resume ---
+    broadcaster = Broadcaster(application.bot, data_path(BROADCAST_STATE_PATH, data_dir))
+    if broadcaster.load():
+        logger.warning(f"📣 Знайдено незавершену розсилку ({len(broadcaster.pending)} отримувачів). Продовжити: /broadcast resume")
+    application.bot_data['broadcaster'] = broadcaster
+
+async def warm_up_election(election: Election, shared: Optional[SharedState]) -> None:
+    """Одночасно заповнює індекс кодів та підрахунок голосів одних виборів зі сховища."""
+    offline = election.offline
+    if not election.storage.is_connected:
+        if offline is not None:
+            offline.enter("немає підключення до Google Sheets")
+        return
+    if offline is not None and offline.pending_count:
+        # Спершу дозаписуємо реєстрації, що залишилися в черзі з попереднього запуску
+        await offline.replay()
+    index_loaded, _ = await asyncio.gather(election.code_index.refresh(), election.tally.reconcile())
+    if not index_loaded and offline is not None:
+        offline.enter("не вдалося прочитати вкладку 'Codes'")
+    if shared:
+        await shared.seed_tally(election)
+
+async def warm_up_caches(application: Application) -> None:
+    """Прогріває кеші всіх виборів одночасно."""
+    elections: Dict[str, Election] = application.bot_data['elections']
+    shared: Optional[SharedState] = application.bot_data.get('shared_state')
+    await asyncio.gather(*[warm_up_election(election, shared) for election in elections.values()])
+
+def build_web_app(application: Application, workers: int = WEBHOOK_WORKERS) -> web.Application:
+    """Створює aiohttp-застосунок з маршрутами /status та вебхука (шлях — токен бота)."""
+    web_app = web.Application()
+    web_app['ptb_app'] = application
+    # Якщо workers > 0, вебхук одразу відповідає 200, а оновлення обробляє пул воркерів
+    web_app['update_dispatcher'] = UpdateDispatcher(application, workers) if workers > 0 else None
+    web_app['webhook_filter'] = WebhookFilter()
+    register_runtime_gauges(application, web_app['update_dispatcher'], web_app['webhook_filter'])
+    web_app.add_routes([
+        web.get('/status', status_handler),
+        web.get('/ready', ready_handler),
+        web.get('/metrics', metrics_handler),
+        # Використовуємо токен бота у шляху для вебхука
+        web.post(f'/{application.bot.token}', handle_telegram_webhook) 
+    ])
+    return web_app
+
+async def background_startup(application: Application, background_tasks: List[asyncio.Task]) -> None:
+    """Фоновий запуск після відкриття порту."""
+    readiness: Readiness = application.bot_data['readiness']
+    elections: List[Election] = list(application.bot_data['elections'].values())
+
+    async def start_telegram() -> None:
+        await application.initialize()
+        await application.start()
+        # Тут використовується оновлена логіка init_webhook, яка коректно формує повний URL
+        await init_webhook(application, WEBHOOK_BASE_URL)
+
+    telegram_started = asyncio.create_task(start_telegram())
+    sheets_connected = asyncio.gather(*[election.sheets.connect() for election in elections])
+
+    # У режимі sqlite з уже заповненими локальними БД не чекаємо на Google Sheets
+    local_ready = all(isinstance(election.storage, SqliteStorage) and election.storage.count_rows("Codes") > 0
+                      for election in elections)
+    if not local_ready or INITIAL_CODE_GENERATION in ('TRUE', 'APPEND'):
+        await sheets_connected
+
+        for election in elections:
+            # 🌟 АВТОМАТИЧНИЙ ЗАПУСК ГЕНЕРАЦІЇ КОДІВ (ПЕРШИЙ ЗАПУСК)
+            if INITIAL_CODE_GENERATION in ('TRUE', 'APPEND') and election.sheets.is_connected:
+                logger.warning(f">>> INITIAL_CODE_GENERATION={INITIAL_CODE_GENERATION}. Виконую одноразову генерацію кодів ({election.title})...")
+                await generate_unique_codes_to_sheets(election.sheets, election.class_config, reset=INITIAL_CODE_GENERATION == 'TRUE',
+                                                      checkpoint_path=election.path(CODE_GENERATION_CHECKPOINT, DATA_DIR))
+                logger.warning(">>> Одноразову генерацію кодів завершено. ВИДАЛІТЬ змінну INITIAL_CODE_GENERATION з Render, щоб уникнути повторного очищення!")
+
+            if election.mirror:
+                await election.mirror.bootstrap()
+
+    # Індекси кодів та підрахунки голосів усіх виборів прогріваються одночасно
+    await warm_up_caches(application)
+    await telegram_started
+    readiness.mark_ready()
+
+    # Видалення прострочених сесій розмов (колесо таймерів) — одне на всі вибори
+    background_tasks.append(asyncio.create_task(session_eviction_task(application.bot_data['sessions'])))
+    for election in elections:
+        if election.offline is not None:
+            # Резервний режим: перевірка зв'язку з Sheets і дозапис черги реєстрацій
+            background_tasks.append(asyncio.create_task(offline_mode_task(election.offline, application.bot)))
+        background_tasks.extend([
+            # Фонове оновлення індексу кодів (підхоплює ручні правки в таблиці)
+            asyncio.create_task(code_index_refresh_task(election.code_index, election.offline)),
+            # Фонове перенесення голосів з журналу у вкладку Votes
+            asyncio.create_task(vote_journal_flush_task(election.journal)),
+        ])
+    if any(election.mirror for election in elections):
+        # У режимі sqlite — фонова синхронізація локальних БД з Google Sheets
+        await sheets_connected
+        background_tasks.extend(asyncio.create_task(mirror_sync_task(election.mirror)) for election in elections if election.mirror)
+
 async def main() -> None:
+    # Відлік часу до відкриття порту та до готовності (див. /metrics)
+    readiness = Readiness()
+
     # Перевірка наявності секрету в змінних середовища
     if GSPREAD_SECRET_JSON.startswith('{"type": "service_account", "placeholder": '):
         logger.error("❌ Критична помилка: Змінна GSPREAD_SECRET_JSON містить заглушку. Будь ласка, замініть її на повний JSON-ключ.")
 
-    # Ініціалізація менеджера Google Sheets
-    sheets_manager = SheetsManager(GSPREAD_SECRET_JSON, SHEET_NAME)
-    
-    # 🌟 АВТОМАТИЧНИЙ ЗАПУСК ГЕНЕРАЦІЇ КОДІВ (ПЕРШИЙ ЗАПУСК)
-    if INITIAL_CODE_GENERATION == 'TRUE' and sheets_manager.is_connected:
-        logger.warning(">>> INITIAL_CODE_GENERATION=TRUE. Виконую одноразову генерацію кодів...")
-        await generate_unique_codes_to_sheets(sheets_manager, CLASS_CONFIG)
-        logger.warning(">>> Одноразову генерацію кодів завершено. ВИДАЛІТЬ змінну INITIAL_CODE_GENERATION з Render, щоб уникнути повторного очищення!")
+    # Локальні файли стану належать лише цьому процесу: друга репліка з тим самим DATA_DIR зупиниться тут
+    data_dir_lock = claim_data_dir(DATA_DIR)
+
+    # Вибори процесу; клієнт Sheets API (квота, пул потоків, авторизація) один на всі вибори
+    elections = load_elections()
+    sheets_api = SheetsApiClient()
 
     # --- Створення та налаштування Application ---
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    application.bot_data['sheets_manager'] = sheets_manager
-    
-    # --- Обробник розмови для голосування ---
-    voting_conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            WAITING_FOR_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_code)],
-            # Фільтр для кнопки "Надіслати контакт"
-            WAITING_FOR_CONTACT: [MessageHandler(filters.CONTACT, receive_contact)], 
-            WAITING_FOR_VOTE: [CallbackQueryHandler(handle_vote, pattern='^vote_.*$')]
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
-        conversation_timeout=3600 # Тайм-аут 1 година
-    )
+    application = build_application()
+    application.bot_data['sheets_api'] = sheets_api
+    application.bot_data['readiness'] = readiness
 
-    application.add_handler(voting_conv)
-    application.add_handler(CommandHandler("cancel", cancel))
-    application.add_handler(CommandHandler("result", show_results)) # Адмін-команда
+    # --- Сховища виборів: Google Sheets або локальна SQLite з Sheets як асинхронним дзеркалом ---
+    # Таблиці створюються без підключення: воно відбувається у фоні
+    for election in elections:
+        open_election_storage(election, sheets_api, data_dir=DATA_DIR)
+    await setup_bot_state(application, elections, data_dir=DATA_DIR)
+    logger.info(f"🗳️ Вибори: {', '.join(f'{election.id} ({election.sheet_name})' for election in elections)}")
     
     # --- Налаштування aiohttp веб-сервера ---
-    web_app = web.Application()
-    web_app['ptb_app'] = application
-    web_app.add_routes([
-        web.get('/status', status_handler),
-        # Використовуємо {TELEGRAM_BOT_TOKEN} у шляху для вебхука
-        web.post(f'/{TELEGRAM_BOT_TOKEN}', handle_telegram_webhook) 
-    ])
-    
-    # ВИПРАВЛЕННЯ: Додаємо keep-alive задачу ДО runner.setup()
-    web_app.on_startup.append(lambda app: asyncio.create_task(keep_alive_task(app)))
+    web_app = build_web_app(application)
+    dispatcher: Optional[UpdateDispatcher] = web_app['update_dispatcher']
 
     runner = web.AppRunner(web_app)
     await runner.setup()
@@ -512,26 +3363,52 @@ async def main() -> None:
     site = web.TCPSite(runner, '0.0.0.0', port) 
 
     # --- Запуск ---
-    await application.initialize()
-    await application.start()
-
-    # 1. Встановлюємо вебхук
-    # Тут використовується оновлена логіка init_webhook, яка коректно формує повний URL
-    await init_webhook(application, WEBHOOK_BASE_URL) 
-
-    # 2. Запускаємо веб-сервер
-    # Render має побачити, що ми почали слухати порт
+    # 1. Спершу відкриваємо порт: Render має якнайшвидше побачити, що ми слухаємо,
+    #    а оновлення, що прийдуть до готовності, чекатимуть у черзі (або отримають 503 і будуть повторені)
     await site.start()
+    readiness.mark_listening()
     logger.info(f"Веб-сервер запущено на http://0.0.0.0:{port}")
+    if dispatcher:
+        dispatcher.start()
+
+    # 2. Keep-Alive та вимірювання затримки циклу подій для /metrics
+    background_tasks: List[asyncio.Task] = [
+        asyncio.create_task(keep_alive_task(web_app)),
+        asyncio.create_task(event_loop_lag_task()),
+    ]
+
+    # 3. Підключення до Sheets, прогрів кешів і решта фонових задач
+    startup_task = asyncio.create_task(background_startup(application, background_tasks))
     
     # Головний цикл для підтримки роботи
     try:
+        await startup_task
         while True:
             await asyncio.sleep(3600)
     finally:
         # Коректне завершення роботи
-        await application.stop()
+        startup_task.cancel()
+        if dispatcher:
+            await dispatcher.stop()
+        for task in background_tasks:
+            task.cancel()
+        await application.bot_data['broadcaster'].stop()
+        for election in elections:
+            await election.live.stop()
+        if application.running:
+            await application.stop()
+        for election in elections:
+            await election.journal.flush()
+            election.journal.close()
+            if election.mirror:
+                await election.mirror.sync()
+                election.storage.close()
+        shared: Optional[SharedState] = application.bot_data.get('shared_state')
+        if shared:
+            await shared.kv.close()
+        sheets_api.shutdown()
         await runner.cleanup()
+        data_dir_lock.close()
         logger.info("Бот та веб-сервер зупинено.")
 
 if __name__ == '__main__':
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeCodesSheet:
+    """Вкладка 'Codes', що запам'ятовує записи; update_row_fields чекає на release, щоб виклики перетнулися."""
+    def __init__(self):
+        self.writes = []
+        self.release = asyncio.Event()
+
+    async def update_row_fields(self, title, row, fields):
+        await self.release.wait()
+        self.writes.append((row, fields['Telegram_ID']))
+        return True
+
+
+class FakeMessage:
+    def __init__(self, user_id):
+        self.contact = SimpleNamespace(user_id=user_id, phone_number='+380000000000')
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def _contact_update(user_id):
+    message = FakeMessage(user_id)
+    user = SimpleNamespace(id=user_id, full_name=f"User {user_id}", username=None)
+    return SimpleNamespace(effective_user=user, callback_query=None, message=message, effective_message=message)
+
+
+def test_reserve_holds_commit():
+    async def scenario():
+        reservations = main.CodeReservations(ttl=60)
+        assert await reservations.reserve('school:AAAAAAAA', 1) == main.CodeReservations.RESERVED
+        assert await reservations.reserve('school:AAAAAAAA', 2) == main.CodeReservations.BUSY
+        assert await reservations.holds('school:AAAAAAAA', 1)
+        assert not await reservations.holds('school:AAAAAAAA', 2)
+
+        await reservations.commit('school:AAAAAAAA', 1)
+        assert not await reservations.holds('school:AAAAAAAA', 1)
+        assert len(reservations) == 0
+
+        # Прострочене резервування не заважає іншому користувачу
+        reservations.ttl = 0
+        assert await reservations.reserve('school:BBBBBBBB', 1) == main.CodeReservations.RESERVED
+        assert await reservations.reserve('school:BBBBBBBB', 2) == main.CodeReservations.RESERVED
+        assert not await reservations.holds('school:BBBBBBBB', 1)
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_contacts_register_code_once():
+    async def scenario():
+        election = main.Election('school', 'Test', 'Test', {'a': 'Candidate A'}, {'11-A': 1})
+        sheet = FakeCodesSheet()
+        election.storage = sheet
+        election.code_index = main.CodeIndex(sheet)
+        reservations = main.CodeReservations(ttl=60)
+        sessions = main.SessionStore(60)
+        context = SimpleNamespace(bot_data={
+            'elections': {'school': election}, 'code_reservations': reservations, 'sessions': sessions,
+        })
+
+        # Резервування користувача 2 спливло, і код перейняв користувач 1; обидва надсилають контакт одночасно
+        for user_id in (1, 2):
+            sessions.put(user_id, main.VoterSession('AAAAAAAA', 2, '11-A', main.WAITING_FOR_CONTACT, election='school'))
+        assert await reservations.reserve('school:AAAAAAAA', 1) == main.CodeReservations.RESERVED
+
+        updates = [_contact_update(1), _contact_update(2)]
+        tasks = [asyncio.create_task(main.receive_contact(update, context)) for update in updates]
+        await asyncio.sleep(0)
+        sheet.release.set()
+
+        assert await asyncio.gather(*tasks) == [main.WAITING_FOR_VOTE, main.ConversationHandler.END]
+        assert sheet.writes == [(2, 1)]
+        assert updates[1].message.replies == ["❌ Час резервування коду минув. Почніть спочатку командою /start."]
+        assert sessions.get(1).state == main.WAITING_FOR_VOTE and sessions.get(2) is None
+        assert len(reservations) == 0
+        assert reservations._locks == {}
+
+    asyncio.run(scenario())
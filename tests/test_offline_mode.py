@@ -0,0 +1,55 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeCodesSheet:
+    """Вкладка 'Codes' в пам'яті; update_row_fields чекає на release, щоб реєстрація встигла стати в чергу."""
+    def __init__(self, codes):
+        self.rows = [[code, 'FALSE', ''] for code in codes]
+        self.release = asyncio.Event()
+        self.writing = asyncio.Event()
+
+    async def read_columns(self, title, names, start_row=2):
+        return [list(row) for row in self.rows]
+
+    async def update_row_fields(self, title, row, fields):
+        self.writing.set()
+        await self.release.wait()
+        self.rows[row - 2][1:] = [fields['Is_Used'], str(fields['Telegram_ID'])]
+        return True
+
+
+def _fields(telegram_id):
+    return {'Is_Used': 'TRUE', 'Telegram_ID': telegram_id}
+
+
+def test_registration_queued_during_replay_is_kept(tmp_path):
+    async def scenario():
+        sheet = FakeCodesSheet(['AAAAAAAA', 'BBBBBBBB'])
+        path = str(tmp_path / 'offline_registrations.jsonl')
+        offline = main.OfflineMode(sheet, main.CodeIndex(sheet), path)
+        assert await offline.queue_registration('AAAAAAAA', 2, _fields(1))
+
+        replay = asyncio.create_task(offline.replay())
+        await sheet.writing.wait()
+        # Поки йде дозапис, бот ще в резервному режимі й ставить нові реєстрації в чергу
+        assert await offline.queue_registration('BBBBBBBB', 3, _fields(2))
+        sheet.release.set()
+        assert await replay == []
+
+        assert offline.pending_count == 1
+        with open(path, encoding='utf-8') as f:
+            assert [json.loads(line)['code'] for line in f] == ['BBBBBBBB']
+
+        assert await offline.replay() == []
+        assert offline.pending_count == 0
+        assert not os.path.exists(path)
+        assert sheet.rows[1][1:] == ['TRUE', '2']
+
+    asyncio.run(scenario())
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeVotesSheet:
+    """Вкладка 'Votes' в пам'яті; fail_after_apply імітує обрив після того, як таблиця вже прийняла рядки."""
+    def __init__(self):
+        self.rows = []
+        self.fail_after_apply = False
+        self.fail_before_apply = False
+
+    async def read_columns(self, title, names, start_row=2):
+        return [[row[0], row[2]] for row in self.rows]
+
+    async def append_rows(self, title, rows):
+        if self.fail_before_apply:
+            return False
+        self.rows.extend(list(row) for row in rows)
+        return not self.fail_after_apply
+
+
+def _vote(n):
+    # Рядок вкладки 'Votes': Timestamp, клас, Unique_Code, Telegram_ID, username, ім'я, кандидат
+    return [f"2025-01-01T00:00:00.{n:06d}", '11-A', f"CODE{n:04d}", 1000 + n, 'N/A', f"User {n}", 'Candidate A']
+
+
+def _reopen(sheet, path):
+    journal = main.VoteJournal(sheet, path)
+    journal.load()
+    return journal
+
+
+def test_unconfirmed_batch_lands_exactly_once(tmp_path):
+    async def scenario():
+        sheet = FakeVotesSheet()
+        path = str(tmp_path / 'votes_journal.jsonl')
+        journal = _reopen(sheet, path)
+        for n in range(3):
+            assert await journal.append(_vote(n))
+
+        # Таблиця записала пакет, але бот не отримав підтвердження і «впав»
+        sheet.fail_after_apply = True
+        assert await journal.flush() == 0
+        journal.close()
+
+        sheet.fail_after_apply = False
+        journal = _reopen(sheet, path)
+        assert journal.pending_count == 3
+        assert await journal.append(_vote(3))
+        assert await journal.flush() == 1
+        journal.close()
+
+        assert sheet.rows == [_vote(n) for n in range(4)]
+        assert _reopen(sheet, path).pending_count == 0
+
+    asyncio.run(scenario())
+
+
+def test_rejected_batch_is_retried_after_restart(tmp_path):
+    async def scenario():
+        sheet = FakeVotesSheet()
+        path = str(tmp_path / 'votes_journal.jsonl')
+        journal = _reopen(sheet, path)
+        for n in range(2):
+            assert await journal.append(_vote(n))
+
+        sheet.fail_before_apply = True
+        assert await journal.flush() == 0
+        journal.close()
+
+        sheet.fail_before_apply = False
+        journal = _reopen(sheet, path)
+        assert await journal.flush() == 2
+        journal.close()
+
+        assert sheet.rows == [_vote(0), _vote(1)]
+
+    asyncio.run(scenario())
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    async def scenario():
+        sheet = FakeVotesSheet()
+        path = str(tmp_path / 'votes_journal.jsonl')
+        journal = _reopen(sheet, path)
+        assert await journal.append(_vote(0))
+        journal.close()
+        # Аварійне завершення посеред запису рядка
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('{"seq": 2, "row": ["2025-')
+
+        journal = _reopen(sheet, path)
+        assert journal.pending_count == 1
+        assert await journal.append(_vote(1))
+        journal.close()
+
+        journal = _reopen(sheet, path)
+        assert journal.pending_rows() == [_vote(0), _vote(1)]
+        assert await journal.flush() == 2
+        journal.close()
+        assert sheet.rows == [_vote(0), _vote(1)]
+
+    asyncio.run(scenario())
+
+
+def test_compacted_journal_is_not_replayed(tmp_path, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(main, 'VOTE_JOURNAL_COMPACT_BYTES', 0)
+        sheet = FakeVotesSheet()
+        path = str(tmp_path / 'votes_journal.jsonl')
+        journal = _reopen(sheet, path)
+        for n in range(2):
+            assert await journal.append(_vote(n))
+        assert await journal.flush() == 2
+        journal.close()
+        assert os.path.getsize(path) == 0
+
+        # Нумерація продовжується з контрольної точки, тож новий голос не сплутається з перенесеними
+        journal = _reopen(sheet, path)
+        assert journal.pending_count == 0
+        assert await journal.append(_vote(2))
+        assert await journal.flush() == 1
+        journal.close()
+
+        assert sheet.rows == [_vote(n) for n in range(3)]
+
+    asyncio.run(scenario())